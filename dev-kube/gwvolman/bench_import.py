@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+"""Check that importing gwvolman's tasks stays fast and side-effect free.
+
+Imports gwvolman.tasks in fresh interpreters, the way a worker does when it
+starts, and fails if the median import time exceeds the budget or if any of
+the modules that should only be loaded by the tasks themselves were imported:
+
+    cd dev-kube/gwvolman/t
+    python3 ../bench_import.py --budget 0.5
+
+Exits with status 1 if the check fails, so it can be used in CI.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Modules which must not be loaded by `import gwvolman.tasks`
+DEFERRED_MODULES = ['docker', 'kubernetes', 'd1_client', 'd1_common', 'jwt', 'yaml',
+                    'gwvolman.publish', 'gwvolman.tasks_docker',
+                    'gwvolman.tasks_kubernetes']
+
+PROBE = '''
+import json, socket, sys, time
+lookups = []
+real_gethostbyname = socket.gethostbyname
+def gethostbyname(host):
+    lookups.append(host)
+    return real_gethostbyname(host)
+socket.gethostbyname = gethostbyname
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'modules': sorted(sys.modules),
+                  'dns_lookups': lookups}}))
+'''
+
+
+def probe_env(path):
+    pythonpath = [path] + [_ for _ in [os.environ.get('PYTHONPATH')] if _]
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(pythonpath))
+
+
+def run_probe(module, path):
+    output = subprocess.check_output(
+        [sys.executable, '-c', PROBE.format(module=module)], env=probe_env(path))
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def slowest_imports(module, path, count):
+    """Returns the `count` slowest imports as reported by -X importtime."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            env=probe_env(path), stderr=subprocess.PIPE,
+                            stdout=subprocess.DEVNULL)
+    timings = []
+    for line in result.stderr.decode().splitlines():
+        fields = [_.strip() for _ in line.split('|')]
+        if len(fields) == 3 and fields[1].isdigit():
+            timings.append((int(fields[1]), fields[2]))
+    return sorted(timings, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--module', default='gwvolman.tasks')
+    parser.add_argument('--budget', type=float, default=1.0,
+                        help='max median import time in seconds')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--path', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 't'),
+        help='directory containing the gwvolman package')
+    args = parser.parse_args()
+
+    probes = [run_probe(args.module, args.path) for _ in range(args.runs)]
+    median = statistics.median(probe['seconds'] for probe in probes)
+    loaded = set(probes[0]['modules'])
+    deferred = [name for name in DEFERRED_MODULES if name in loaded]
+    lookups = probes[0]['dns_lookups']
+
+    print('import {}: median {:.3f}s over {} runs (budget {:.3f}s)'.format(
+        args.module, median, args.runs, args.budget))
+    print('slowest imports (cumulative us):')
+    for micros, name in slowest_imports(args.module, args.path, 10):
+        print('    {:>10} {}'.format(micros, name))
+
+    failures = []
+    if median > args.budget:
+        failures.append('import took {:.3f}s, over the {:.3f}s budget'.format(
+            median, args.budget))
+    if deferred:
+        failures.append('modules loaded on import: {}'.format(', '.join(deferred)))
+    if lookups:
+        failures.append('DNS lookups on import: {}'.format(', '.join(lookups)))
+    for failure in failures:
+        print('FAIL: ' + failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
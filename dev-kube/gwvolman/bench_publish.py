@@ -0,0 +1,330 @@
+#!/usr/bin/python3
+"""Benchmark gwvolman's publish_tale against local stand-ins.
+
+Runs publish.publish_tale end to end against a fake Girder API and a fake
+DataONE member node, both served from this process over HTTP with
+configurable latency and bandwidth. Nothing leaves the machine, so this can
+be run on a new worker image before it's deployed:
+
+    cd dev-kube/gwvolman/t
+    python3 ../bench_publish.py --files 500 --size 4k-16m --mix 8:1:1
+
+Reports the wall time, the bytes served by Girder and received by the member
+node, the peak RSS of the process (which includes the stand-ins) and the
+number of requests made to each service. Use --json for machine-readable
+output.
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SIZE_RE = re.compile(r'^(\d+)([kmg]?)$', re.IGNORECASE)
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+BLOCK = random.Random(0).getrandbits(8 * 65536).to_bytes(65536, 'little')
+
+
+def parse_size(value):
+    match = SIZE_RE.match(value)
+    if not match:
+        raise argparse.ArgumentTypeError('invalid size: {}'.format(value))
+    return int(match.group(1)) * SIZE_UNITS[match.group(2).lower()]
+
+
+def parse_size_range(value):
+    """'64k' is a fixed size, '4k-16m' is log-uniformly distributed."""
+    low, _, high = value.partition('-')
+    low = parse_size(low)
+    return low, parse_size(high) if high else low
+
+
+def parse_mix(value):
+    try:
+        mix = [float(_) for _ in value.split(':')]
+    except ValueError:
+        mix = []
+    if len(mix) != 3 or sum(mix) <= 0:
+        raise argparse.ArgumentTypeError('expected local:remote:dataone, e.g. 8:1:1')
+    return mix
+
+
+def content(key, size):
+    """Yields `size` bytes of deterministic content for `key` in 64k chunks."""
+    offset = int(hashlib.md5(key.encode()).hexdigest(), 16) % len(BLOCK)
+    block = BLOCK[offset:] + BLOCK[:offset]
+    while size > 0:
+        chunk = block[:min(size, len(block))]
+        size -= len(chunk)
+        yield chunk
+
+
+class StandIn(ThreadingHTTPServer):
+    """An HTTP server that simulates latency and bandwidth, and keeps stats."""
+
+    daemon_threads = True
+
+    def __init__(self, handler, latency, bandwidth):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests = Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_port)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def count(self, route):
+        with self.server.lock:
+            self.server.requests['{} {}'.format(self.command, route)] += 1
+        time.sleep(self.server.latency)
+
+    def throttle(self, nbytes):
+        if self.server.bandwidth:
+            time.sleep(nbytes / self.server.bandwidth)
+
+    def read_body(self):
+        nbytes = 0
+        if 'chunked' in self.headers.get('Transfer-Encoding', ''):
+            while True:
+                length = int(self.rfile.readline().split(b';')[0], 16)
+                nbytes += len(self.rfile.read(length))
+                self.rfile.readline()
+                if length == 0:
+                    break
+        else:
+            remaining = int(self.headers.get('Content-Length', 0))
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, 65536))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                nbytes += len(chunk)
+                self.throttle(len(chunk))
+        with self.server.lock:
+            self.server.bytes_received += nbytes
+        return nbytes
+
+    def send_body(self, chunks, size, content_type, headers=None):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(size))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        for chunk in chunks:
+            self.wfile.write(chunk)
+            self.throttle(len(chunk))
+        with self.server.lock:
+            self.server.bytes_sent += size
+
+    def send_json(self, doc):
+        body = json.dumps(doc).encode()
+        self.send_body([body], len(body), 'application/json')
+
+    def send_status(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class GirderHandler(StandInHandler):
+    """Serves the parts of the Girder API used by publish_tale."""
+
+    def do_GET(self):
+        path, _, _ = self.path.partition('?')
+        parts = [_ for _ in path.split('/') if _]
+        tale = self.server.tale
+        if parts[:2] == ['recipe', 'tarball']:
+            self.count('recipe tarball')
+            return self.send_body(content('environment', tale.env_size), tale.env_size,
+                                  'application/gzip')
+        if parts[:1] == ['remote']:
+            self.count('remote file')
+            size = tale.files[parts[1]]['size']
+            return self.send_body(content(parts[1], size), size, 'text/csv',
+                                  {'ETag': '"{}"'.format(parts[1])})
+        if parts[:2] != ['api', 'v1']:
+            return self.send_status(404)
+
+        resource_type, ids, rest = parts[2], parts[3:4], parts[4:]
+        self.count('{} {}'.format(resource_type, '/'.join(rest)).strip())
+        if resource_type == 'tale':
+            return self.send_json(tale.tale)
+        if resource_type == 'user':
+            return self.send_json(tale.user)
+        if resource_type == 'image':
+            return self.send_json({'_id': ids[0], 'recipeId': 'recipe', 'config': {}})
+        if resource_type == 'recipe':
+            return self.send_json({'_id': ids[0], 'url': self.server.url + '/recipe',
+                                   'commitId': 'c0ffee'})
+        if resource_type == 'resource' and rest == ['path']:
+            return self.send_json('/collection/Bench/data')
+        if resource_type == 'item' and not rest:
+            return self.send_json(tale.items[ids[0]])
+        if resource_type == 'item' and rest == ['files']:
+            return self.send_json([tale.files[ids[0]]])
+        if resource_type == 'file' and rest == ['download']:
+            file = tale.files[ids[0]]
+            return self.send_body(content(ids[0], file['size']), file['size'],
+                                  'application/octet-stream')
+        self.send_status(404)
+
+    do_HEAD = do_GET
+
+
+class MemberNodeHandler(StandInHandler):
+    """Accepts object creation like a DataONE member node."""
+
+    def do_POST(self):
+        self.count('create')
+        self.read_body()
+        body = ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<d1:identifier xmlns:d1="http://ns.dataone.org/service/types/v1">'
+                '{}</d1:identifier>').format(self.server.next_pid()).encode()
+        self.send_body([body], len(body), 'text/xml')
+
+    def do_HEAD(self):
+        # describe(): no object is ever found, so nothing is deduplicated
+        self.count('describe')
+        self.send_status(404)
+
+    do_GET = do_HEAD
+
+
+class BenchTale(object):
+    """The Tale, user, items and files served by the fake Girder."""
+
+    def __init__(self, count, size_range, mix, env_size, seed):
+        rng = random.Random(seed)
+        low, high = size_range
+        self.env_size = env_size
+        self.items = dict()
+        self.files = dict()
+        self.total_local_bytes = 0
+        kinds = rng.choices(['local', 'remote', 'dataone'], weights=mix, k=count)
+        for i, kind in enumerate(kinds):
+            item_id = 'item{:06d}'.format(i)
+            if low == high:
+                size = low
+            else:
+                size = int(math.exp(rng.uniform(math.log(max(low, 1)), math.log(high))))
+            file = {'_id': item_id, 'itemId': item_id, 'name': 'data{:06d}.csv'.format(i),
+                    'size': size, 'mimeType': 'text/csv', 'created': '2018-01-01'}
+            if kind == 'remote':
+                file['linkUrl'] = None  # set once the server url is known
+            elif kind == 'dataone':
+                file['linkUrl'] = 'https://cn.dataone.org/cn/v2/resolve/bench.{}'.format(i)
+            else:
+                self.total_local_bytes += size
+            self.files[item_id] = file
+            self.items[item_id] = {'_id': item_id, 'name': file['name'], 'size': size,
+                                   'folderId': 'folder{}'.format(i % 10),
+                                   'description': 'Benchmark item {}'.format(i)}
+        self.kinds = Counter(kinds)
+        self.tale = {'_id': 'tale', 'title': 'Benchmark Tale', 'description': 'Benchmark',
+                     'imageId': 'image', 'category': 'science', 'format': 1, 'config': {}}
+        self.user = {'_id': 'user', 'firstName': 'Bench', 'lastName': 'Mark',
+                     'email': 'bench@localhost'}
+
+    def set_remote_base(self, url):
+        for item_id, file in self.files.items():
+            if 'linkUrl' in file and file['linkUrl'] is None:
+                file['linkUrl'] = '{}/remote/{}'.format(url, item_id)
+
+
+def make_token():
+    import jwt
+    token = jwt.encode({'userId': 'http://orcid.org/0000-0000-0000-0000'}, 'bench')
+    return token.decode() if isinstance(token, bytes) else token
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=100, help='number of items')
+    parser.add_argument('--size', type=parse_size_range, default=parse_size_range('64k'),
+                        help='file size, or a log-uniform range such as 4k-16m')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('8:1:1'),
+                        help='relative share of local:remote:dataone items')
+    parser.add_argument('--env-size', type=parse_size, default=parse_size('1m'),
+                        help='size of the environment tarball')
+    parser.add_argument('--girder-latency', type=float, default=0.005,
+                        help='seconds added to each Girder request')
+    parser.add_argument('--mn-latency', type=float, default=0.05,
+                        help='seconds added to each member node request')
+    parser.add_argument('--bandwidth', type=parse_size, default=0,
+                        help='bytes per second per connection, 0 for unlimited')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    tale = BenchTale(args.files, args.size, args.mix, args.env_size, args.seed)
+    girder = StandIn(GirderHandler, args.girder_latency, args.bandwidth)
+    girder.tale = tale
+    tale.set_remote_base(girder.url)
+    member_node = StandIn(MemberNodeHandler, args.mn_latency, args.bandwidth)
+    pids = iter(range(sys.maxsize))
+    member_node.next_pid = lambda: 'bench.{}'.format(next(pids))
+
+    # Start cold: no checksum, tarball or journal entries from earlier runs
+    os.environ['GIRDER_API_URL'] = girder.url + '/api/v1'
+    os.environ['GWVOLMAN_CACHE_DIR'] = tempfile.mkdtemp(prefix='bench-publish-')
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 't'))
+    from gwvolman.publish import publish_tale
+    from gwvolman.progress import JobProgress
+
+    progress = JobProgress()
+    start = time.monotonic()
+    publish_tale(sorted(tale.items), 'tale', member_node.url + '/mn/v2', make_token(),
+                 'girder-token', 'user', {}, 'CC-BY-4.0', progress)
+    wall_time = time.monotonic() - start
+
+    results = {
+        'files': dict(tale.kinds),
+        'local_bytes': tale.total_local_bytes,
+        'wall_seconds': round(wall_time, 3),
+        'girder_bytes_sent': girder.bytes_sent,
+        'member_node_bytes_received': member_node.bytes_received,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'girder_requests': dict(girder.requests),
+        'member_node_requests': dict(member_node.requests),
+        'member_node_connections': progress.info.get('dataone_connections', {}),
+        'stages': {name: stage['seconds'] for name, stage in progress.stages.items()},
+    }
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    for key, value in results.items():
+        if isinstance(value, dict):
+            print('{}:'.format(key))
+            for name, count in sorted(value.items()):
+                print('    {:<30} {}'.format(name, count))
+        else:
+            print('{:<34} {}'.format(key + ':', value))
+
+
+if __name__ == '__main__':
+    main()
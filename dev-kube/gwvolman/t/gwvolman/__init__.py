@@ -18,7 +18,22 @@ class GWVolumeManagerPlugin(GirderWorkerPluginABC):
             Broadcast('broadcast_tasks')
         )
         self.app.conf.task_routes = {
-            'gwvolman.tasks.shutdown_container': {'queue': 'broadcast_tasks'}
+            'gwvolman.tasks.shutdown_container': {'queue': 'broadcast_tasks'},
+            'gwvolman.tasks.refill_pool': {'queue': 'broadcast_tasks'},
+            'gwvolman.tasks.prepull_image': {'queue': 'broadcast_tasks'}
+        }
+        # Every node maintains its own warm pool, while a single worker culls
+        # the idle instances of the whole deployment. The schedule is sent by
+        # a single `python -m gwvolman.beat` process, see beat.py
+        self.app.conf.beat_schedule = {
+            'refill-warm-pool': {
+                'task': 'gwvolman.tasks.refill_pool',
+                'schedule': float(os.environ.get('WARM_POOL_REFILL_INTERVAL', 60))
+            },
+            'cull-idle-instances': {
+                'task': 'gwvolman.tasks.cull_idle_instances',
+                'schedule': float(os.environ.get('CULL_INTERVAL', 600))
+            }
         }
         # self.app.config.update({
         #     'TASK_TIME_LIMIT': 300
@@ -0,0 +1,20 @@
+"""Runs the celery beat scheduler of the gwvolman periodic tasks.
+
+The schedule is set up by GWVolumeManagerPlugin, which only girder-worker
+loads, so a plain `celery beat` wouldn't see it. Exactly one scheduler must
+run per deployment, or the tasks would be sent once per scheduler:
+
+    python -m gwvolman.beat
+"""
+from girder_worker.app import app
+
+from . import GWVolumeManagerPlugin
+
+
+def main():
+    GWVolumeManagerPlugin(app)
+    app.Beat(loglevel='INFO').run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""Caches shared by the tasks that run in a worker."""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_DIR = os.environ.get('GWVOLMAN_CACHE_DIR',
+                           os.path.join(tempfile.gettempdir(), 'gwvolman'))
+
+
+class PersistentCache(object):
+    """An on-disk key/value store for JSON serializable values.
+
+    Each key is kept in its own file, and files are replaced atomically, so the
+    cache can be shared by all threads and processes of a worker node and
+    survives worker restarts. Failing to read or write the cache is never
+    fatal: a broken entry reads as missing.
+    """
+
+    def __init__(self, name, cache_dir=None):
+        self.path = os.path.join(cache_dir or CACHE_DIR, name)
+
+    def _path(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:2], digest)
+
+    def get(self, key, default=None):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return default
+
+    def set(self, key, value):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(value, f)
+            os.replace(temp_path, path)
+        except (IOError, OSError) as e:
+            logging.warning('Failed to write cache entry {}: {}'.format(path, e))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+class TTLCache(object):
+    """An in-memory LRU cache whose entries expire after `ttl` seconds.
+
+    The cache holds at most `maxsize` entries and is shared by all threads of a
+    worker process. Concurrent `get_or_set` calls for a missing key wait for a
+    single computation of its value instead of each computing it.
+    """
+
+    _missing = object()
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # One lock per key whose value is being computed
+        self._inflight = dict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if time.monotonic() > expires:
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_or_set(self, key, compute):
+        """
+        Returns the cached value of `key`, or caches and returns `compute()`.
+
+        :param key: The key of the value
+        :param compute: Returns the value when it isn't cached
+        :type compute: callable
+        """
+        value = self.get(key, self._missing)
+        if value is not self._missing:
+            return value
+        with self._lock:
+            lock = self._inflight.setdefault(key, threading.Lock())
+        with lock:
+            # Computed by another thread while this one waited
+            value = self.get(key, self._missing)
+            if value is self._missing:
+                try:
+                    value = compute()
+                    self.set(key, value)
+                finally:
+                    with self._lock:
+                        self._inflight.pop(key, None)
+            return value
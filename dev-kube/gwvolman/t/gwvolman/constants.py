@@ -12,11 +12,25 @@ MOUNTPOINTS = ['data', 'home']
 if ENABLE_WORKSPACES:
     MOUNTPOINTS.append('workspace')
 
-try:
-    DEFAULT_GIRDER_API_URL = 'http://' + socket.gethostbyname('girder') + ':8080/api/v1'
-except socket.gaierror:
-    DEFAULT_GIRDER_API_URL = 'https://girder.dev.wholetale.org/api/v1'
-GIRDER_API_URL = os.environ.get('GIRDER_API_URL', DEFAULT_GIRDER_API_URL)
+_girder_api_url = None
+
+
+def get_girder_api_url():
+    """
+    Returns the url of the Girder API. Unless GIRDER_API_URL is set, it's
+    resolved from the `girder` host on first use rather than on import, so that
+    importing gwvolman never blocks on DNS.
+    """
+    global _girder_api_url
+    if _girder_api_url is None:
+        url = os.environ.get('GIRDER_API_URL')
+        if url is None:
+            try:
+                url = 'http://' + socket.gethostbyname('girder') + ':8080/api/v1'
+            except socket.gaierror:
+                url = 'https://girder.dev.wholetale.org/api/v1'
+        _girder_api_url = url
+    return _girder_api_url
 
 
 class InstanceStatus(object):
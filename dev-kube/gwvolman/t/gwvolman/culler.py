@@ -0,0 +1,149 @@
+"""Culling of idle Tale instances.
+
+The culler runs periodically on one worker. It reads the activity of each
+running instance from its server: Jupyter's /api/status reports the last
+HTTP request or kernel activity. Instances idle for longer than
+CULL_IDLE_TIMEOUT are deleted through Girder, which shuts down their
+container and removes their volume, a batch at a time so that a burst of
+shutdowns doesn't overload the nodes or Girder.
+
+Instances whose server doesn't report its activity are only culled once they
+are older than CULL_MAX_AGE, if set.
+"""
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+try:
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from urllib.parse import urlparse, parse_qs
+
+import girder_client
+
+from .constants import InstanceStatus, get_girder_api_url
+from .readiness import READINESS_VERIFY_TLS
+from .utils import get_http_session
+
+# Seconds without activity after which an instance is shut down (0: never)
+CULL_IDLE_TIMEOUT = float(os.environ.get('CULL_IDLE_TIMEOUT', 4 * 3600))
+# Seconds after which an instance is shut down regardless of activity (0: never)
+CULL_MAX_AGE = float(os.environ.get('CULL_MAX_AGE', 0))
+# Number of instances shut down at once, and seconds between two batches
+CULL_BATCH_SIZE = int(os.environ.get('CULL_BATCH_SIZE', 10))
+CULL_BATCH_DELAY = float(os.environ.get('CULL_BATCH_DELAY', 5))
+# Number of concurrent activity requests, and their timeout in seconds
+CULL_PROBE_WORKERS = int(os.environ.get('CULL_PROBE_WORKERS', 16))
+CULL_PROBE_TIMEOUT = float(os.environ.get('CULL_PROBE_TIMEOUT', 10))
+# API key of a Girder admin, used to list and delete the instances of all users
+CULLER_API_KEY = os.environ.get('CULLER_GIRDER_API_KEY')
+
+
+def _parse_time(value):
+    """Parses an ISO 8601 timestamp from Girder or Jupyter, as UTC if naive."""
+    when = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.timestamp()
+
+
+def get_server_activity(url, timeout=CULL_PROBE_TIMEOUT):
+    """
+    Returns the last activity reported by the instance's server.
+
+    :param url: The url of the instance, with its token if any
+    :type url: str
+    :return: The time of the last activity, or None if the server doesn't
+     report it
+    :rtype: float
+    """
+    if not url:
+        return None
+    parsed = urlparse(url)
+    token = parse_qs(parsed.query).get('token', [None])[0]
+    status_url = '{}://{}/api/status'.format(parsed.scheme, parsed.netloc)
+    try:
+        resp = get_http_session().get(
+            status_url, params={'token': token} if token else None,
+            timeout=timeout, verify=READINESS_VERIFY_TLS)
+        resp.raise_for_status()
+        return _parse_time(resp.json()['last_activity'])
+    except Exception as e:
+        logging.debug('No activity reported by {}: {}'.format(status_url, e))
+        return None
+
+
+def is_idle(instance, activity, now=None):
+    """
+    Tells whether an instance should be culled.
+
+    :param instance: The instance
+    :param activity: The time of its last activity, or None if unknown
+    :type instance: dict
+    :type activity: float
+    :rtype: bool
+    """
+    now = now or time.time()
+    try:
+        created = _parse_time(instance['created'])
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        # Don't let one malformed instance abort the whole run
+        logging.warning('Skipping instance {} with no valid creation time: {}'.format(
+            instance.get('_id'), e))
+        return False
+    if CULL_MAX_AGE and now - created > CULL_MAX_AGE:
+        return True
+    if activity is None or not CULL_IDLE_TIMEOUT:
+        return False
+    # A new instance is active until its first request
+    return now - max(activity, created) > CULL_IDLE_TIMEOUT
+
+
+def _get_girder_client():
+    gc = girder_client.GirderClient(apiUrl=get_girder_api_url())
+    gc.authenticate(apiKey=CULLER_API_KEY)
+    return gc
+
+
+def _cull_instance(gc, instance):
+    try:
+        gc.delete('/instance/{}'.format(instance['_id']))
+        logging.info('Culled idle instance {}'.format(instance['_id']))
+        return True
+    except girder_client.HttpError as e:
+        logging.warning('Failed to cull instance {}: {}'.format(instance['_id'], e))
+        return False
+
+
+def cull_idle_instances():
+    """
+    Shuts down the running instances that are idle.
+
+    :return: The number of instances checked, found idle and culled
+    :rtype: dict
+    """
+    if not CULLER_API_KEY or not (CULL_IDLE_TIMEOUT or CULL_MAX_AGE):
+        return {'checked': 0, 'idle': 0, 'culled': 0}
+    gc = _get_girder_client()
+    instances = [instance for instance in gc.listResource('/instance')
+                 if instance['status'] == InstanceStatus.RUNNING]
+
+    with ThreadPoolExecutor(max_workers=CULL_PROBE_WORKERS) as executor:
+        activities = list(executor.map(
+            lambda instance: get_server_activity(instance.get('url')), instances))
+        now = time.time()
+        idle = [instance for instance, activity in zip(instances, activities)
+                if is_idle(instance, activity, now)]
+
+        culled = 0
+        for start in range(0, len(idle), CULL_BATCH_SIZE):
+            if start:
+                time.sleep(CULL_BATCH_DELAY)
+            batch = idle[start:start + CULL_BATCH_SIZE]
+            culled += sum(executor.map(lambda instance: _cull_instance(gc, instance),
+                                       batch))
+
+    summary = {'checked': len(instances), 'idle': len(idle), 'culled': culled}
+    logging.info('Culler summary: {}'.format(summary))
+    return summary
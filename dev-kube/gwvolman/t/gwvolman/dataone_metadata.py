@@ -12,8 +12,8 @@ from .utils import \
     strip_html_tags, \
     check_pid, \
     get_directory, \
-    get_file_item, \
-    compute_md5
+    compute_md5, \
+    prefetch_item_metadata
 
 
 from d1_common.types import dataoneTypes
@@ -178,10 +178,12 @@ def create_minimum_eml(tale,
                        file_sizes,
                        license_id,
                        user_id,
-                       gc):
+                       gc,
+                       metadata=None):
     """
     Creates a bare minimum EML record for a package. Note that the
-    ordering of the xml elements matters.
+    ordering of the xml elements matters. See write_minimum_eml for a version
+    that doesn't hold the whole document in memory.
 
     :param tale: The tale that is being packaged.
     :param user: The user that hit the endpoint
@@ -193,6 +195,7 @@ def create_minimum_eml(tale,
     :param user_id: The user's user id from the JWT
     girder items/files
     :param gc: The girder client
+    :param metadata: The prefetched item metadata, see prefetch_item_metadata
     :type tale: wholetale.models.tale
     :type user: girder.models.user
     :type item_ids: list
@@ -200,9 +203,48 @@ def create_minimum_eml(tale,
     :type file_sizes: dict
     :type license_id: str
     :type user_id: str
+    :type metadata: dict
     :return: The EML as as string of bytes
     :rtype: bytes
     """
+    stream = io.BytesIO()
+    error = write_minimum_eml(stream,
+                              tale,
+                              user,
+                              item_ids,
+                              eml_pid,
+                              file_sizes,
+                              license_id,
+                              user_id,
+                              gc,
+                              metadata)
+    if error is not None:
+        return error
+    return stream.getvalue()
+
+
+def write_minimum_eml(stream,
+                      tale,
+                      user,
+                      item_ids,
+                      eml_pid,
+                      file_sizes,
+                      license_id,
+                      user_id,
+                      gc,
+                      metadata=None):
+    """
+    Writes a bare minimum EML record for a package to a binary stream. The
+    `otherEntity` records are serialized and written one at a time, so memory
+    use doesn't grow with the number of items. The output is the same as
+    serializing the complete tree with ElementTree.
+
+    See create_minimum_eml for a description of the parameters.
+
+    :param stream: An open, writable binary file handle
+    :return: None, or an error message if the record can't be created
+    :rtype: str
+    """
 
     """
     Check that we're able to assign a first, last, and email to the record.
@@ -258,68 +300,78 @@ def create_minimum_eml(tale,
     set_user_name(contact, first_name, last_name)
     set_user_contact(contact, user_id, email)
 
+    """
+    Emulate the behavior of ElementTree.tostring in Python 3.6.0
+     Write the contents to a stream and then return its content.
+     The Python 3.4 version of ElementTree.tostring doesn't allow for
+     `xml_declaration` to be set, so make a direct call to
+     ElementTree.write, passing xml_declaration in.
+
+    Only the header of the document is serialized this way. It always ends by
+     closing `dataset` and the root element, so the `otherEntity` records are
+     written in between as they're produced.
+    """
+    header = io.BytesIO()
+    ET.ElementTree(ns).write(file_or_filename=header,
+                             encoding='UTF-8',
+                             xml_declaration=True,
+                             method='xml',
+                             short_empty_elements=True)
+    footer = b'</dataset></eml:eml>'
+    header = header.getvalue()
+    stream.write(header[:-len(footer)])
+
+    for record in _iter_object_records(item_ids, file_sizes, gc, metadata):
+        parent = ET.Element('dataset')
+        add_object_record(parent, *record)
+        stream.write(ET.tostring(parent[0],
+                                 encoding='unicode',
+                                 method='xml',
+                                 short_empty_elements=True).encode('utf-8'))
+
+    stream.write(footer)
+
+
+def _iter_object_records(item_ids, file_sizes, gc, metadata=None):
+    """
+    Yields the name, description, size and format of each object described by
+    the EML, in document order.
+    """
+    if metadata is None:
+        metadata = prefetch_item_metadata(item_ids, gc)
+
     # Add a <otherEntity> block for each object
     for item_id in item_ids:
 
         # Create the record for the object
-        item = gc.getItem(item_id)
-        file = get_file_item(item_id, gc)
-        add_object_record(dataset,
-                          item['name'],
-                          item.get('description', ''),
-                          item['size'],
-                          file['mimeType'])
+        item, file = metadata[item_id].item, metadata[item_id].file
+        yield (item['name'],
+               item.get('description', ''),
+               item['size'],
+               file['mimeType'])
 
     # Add a section for the tale.yml file
     logging.debug('Adding tale.yaml to EML')
-    file_sizes.get('tale_yaml')
-    description = file_descriptions[ExtraFileNames.tale_config]
-    name = ExtraFileNames.tale_config
-    object_format = 'application/x-yaml'
-    add_object_record(dataset,
-                      name,
-                      description,
-                      file_sizes.get('tale_yaml'),
-                      object_format)
+    yield (ExtraFileNames.tale_config,
+           file_descriptions[ExtraFileNames.tale_config],
+           file_sizes.get('tale_yaml'),
+           'application/x-yaml')
 
     # Add a section for the license file
     if file_sizes.get('license'):
         logging.debug('Adding LICENSE to EML')
-        description = file_descriptions[ExtraFileNames.license_filename]
-        name = ExtraFileNames.license_filename
-        object_format = 'text/plain'
-        add_object_record(dataset,
-                          name,
-                          description,
-                          file_sizes.get('license'),
-                          object_format)
+        yield (ExtraFileNames.license_filename,
+               file_descriptions[ExtraFileNames.license_filename],
+               file_sizes.get('license'),
+               'text/plain')
 
     # Add a section for the repository file
     if file_sizes.get('repository'):
         logging.debug('Adding repository.tar.gz to EML')
-        description = file_descriptions[ExtraFileNames.environment_file]
-        name = ExtraFileNames.environment_file
-        object_format = 'application/tar+gzip'
-        add_object_record(dataset,
-                          name,
-                          description,
-                          file_sizes.get('repository'),
-                          object_format)
-    """
-    Emulate the behavior of ElementTree.tostring in Python 3.6.0
-     Write the contents to a stream and then return its content.
-     The Python 3.4 version of ElementTree.tostring doesn't allow for
-     `xml_declaration` to be set, so make a direct call to
-     ElementTree.write, passing xml_declaration in.
-    """
-    stream = io.BytesIO()
-    ET.ElementTree(ns).write(file_or_filename=stream,
-                             encoding='UTF-8',
-                             xml_declaration=True,
-                             method='xml',
-                             short_empty_elements=True)
-
-    return stream.getvalue()
+        yield (ExtraFileNames.environment_file,
+               file_descriptions[ExtraFileNames.environment_file],
+               file_sizes.get('repository'),
+               'application/tar+gzip')
 
 
 def generate_system_metadata(pid,
@@ -0,0 +1,230 @@
+"""Discovery of the services of a WT deployment."""
+import logging
+import os
+import threading
+import time
+
+# Where the deployment is discovered: 'docker' (swarm services), 'kubernetes'
+# (Ingress and Service annotations) or 'env' (environment variables only)
+DEPLOYMENT_BACKEND = os.environ.get('DEPLOYMENT_BACKEND', 'docker')
+# Seconds after which a discovered value is looked up again
+DEPLOYMENT_TTL = float(os.environ.get('DEPLOYMENT_TTL', 300))
+KUBERNETES_NAMESPACE_FILE = '/var/run/secrets/kubernetes.io/serviceaccount/namespace'
+
+# Environment variables that override the discovered value of each setting
+ENV_OVERRIDES = {
+    'traefik_network': 'TRAEFIK_NETWORK',
+    'dashboard_url': 'DASHBOARD_URL',
+    'girder_url': 'GIRDER_URL',
+    'registry_url': 'REGISTRY_URL',
+}
+
+
+def get_kubernetes_namespace():
+    """Returns the namespace of the worker's pod, or KUBERNETES_NAMESPACE if set."""
+    namespace = os.environ.get('KUBERNETES_NAMESPACE')
+    if namespace is None:
+        try:
+            with open(KUBERNETES_NAMESPACE_FILE) as f:
+                namespace = f.read().strip()
+        except IOError:
+            namespace = 'default'
+    return namespace
+
+
+class EnvBackend(object):
+    """Reads the deployment configuration from environment variables.
+
+    Only the variables in ENV_OVERRIDES are used, unless `domain` is given, in
+    which case the urls default to the usual `<service>.<domain>` hosts.
+    """
+
+    def __init__(self, domain=None):
+        self.domain = domain
+
+    def lookup(self, name):
+        value = os.environ.get(ENV_OVERRIDES[name])
+        if value is None and self.domain and name.endswith('_url'):
+            value = 'https://{}.{}'.format(name[:-len('_url')], self.domain)
+        return value
+
+
+class DockerBackend(object):
+    """Reads the configuration from the labels of the docker swarm services."""
+
+    services = {
+        'dashboard_url': 'wt_dashboard',
+        'girder_url': 'wt_girder',
+        'registry_url': 'wt_registry',
+    }
+
+    def __init__(self):
+        self._client = None
+
+    @property
+    def docker_client(self):
+        # The client is only created when first needed, so that importing
+        # gwvolman doesn't touch the docker socket
+        if self._client is None:
+            import docker
+            self._client = docker.from_env(version='1.28')
+        return self._client
+
+    def lookup(self, name):
+        if name == 'traefik_network':
+            service = self.docker_client.services.get('wt_dashboard')
+            return service.attrs['Spec']['Labels']['traefik.docker.network']
+        return self.get_host_from_traefik_rule(self.services[name])
+
+    def get_host_from_traefik_rule(self, service_name):
+        """Infer service's hostname from traefik frontend rule label."""
+        service = self.docker_client.services.get(service_name)
+        rule = service.attrs['Spec']['Labels']['traefik.frontend.rule']
+        return 'https://' + rule.split(':')[-1].split(',')[0].strip()
+
+
+class KubernetesBackend(object):
+    """Reads the configuration from the Ingress rules and Service annotations.
+
+    A `wholetale.org/url` annotation on a Service takes precedence over the
+    host of the Ingress rule that routes to it. The traefik network has no
+    equivalent on kubernetes and is only read from the
+    `wholetale.org/traefik-network` annotation of the dashboard Service.
+    """
+
+    services = {
+        'dashboard_url': 'dashboard',
+        'girder_url': 'girder',
+        'registry_url': 'registry',
+    }
+
+    def __init__(self, namespace=None):
+        self.namespace = namespace or get_kubernetes_namespace()
+        self._api = None
+
+    @property
+    def api(self):
+        if self._api is None:
+            from kubernetes import client, config
+            config.load_incluster_config()
+            self._api = (client.CoreV1Api(), client.ExtensionsV1beta1Api())
+        return self._api
+
+    def _annotation(self, service_name, key):
+        from kubernetes.client.rest import ApiException
+        try:
+            service = self.api[0].read_namespaced_service(service_name, self.namespace)
+        except ApiException as e:
+            if e.status == 404:
+                return None
+            raise
+        return (service.metadata.annotations or {}).get(key)
+
+    def lookup(self, name):
+        if name == 'traefik_network':
+            return self._annotation(self.services['dashboard_url'],
+                                    'wholetale.org/traefik-network')
+        service_name = self.services[name]
+        url = self._annotation(service_name, 'wholetale.org/url')
+        if url is not None:
+            return url
+        for ingress in self.api[1].list_namespaced_ingress(self.namespace).items:
+            tls_hosts = set()
+            for tls in ingress.spec.tls or []:
+                tls_hosts.update(tls.hosts or [])
+            for rule in ingress.spec.rules or []:
+                paths = rule.http.paths if rule.http else []
+                if any(path.backend.service_name == service_name for path in paths):
+                    scheme = 'https' if rule.host in tls_hosts else 'http'
+                    return '{}://{}'.format(scheme, rule.host)
+        return None
+
+
+BACKENDS = {
+    'docker': DockerBackend,
+    'kubernetes': KubernetesBackend,
+    'env': lambda: EnvBackend(domain=os.environ.get('DOMAIN', 'dev.wholetale.org')),
+}
+
+
+class Deployment(object):
+    """Container for WT-specific deployment configuration.
+
+    This class allows to read and store configuration of services in a WT
+    deployment. It's meant to be used as a singleton across gwvolman.
+
+    Settings are looked up on first use, first in the environment (see
+    ENV_OVERRIDES) and then with the configured backend. They're cached for
+    `ttl` seconds, so changes to the deployment are picked up without
+    restarting the worker. If a lookup fails once a value is known, the
+    previous value is kept until the next attempt.
+    """
+
+    def __init__(self, backend=None, ttl=DEPLOYMENT_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self._env = EnvBackend()
+        self._cache = dict()
+        self._lock = threading.Lock()
+
+    @property
+    def backends(self):
+        if self.backend is None:
+            try:
+                self.backend = BACKENDS[DEPLOYMENT_BACKEND]()
+            except KeyError:
+                raise ValueError('Unsupported deployment backend: {}'.format(
+                    DEPLOYMENT_BACKEND))
+        return [self._env, self.backend]
+
+    def get(self, name):
+        """
+        Returns a setting of the deployment.
+
+        :param name: One of the keys of ENV_OVERRIDES
+        :type name: str
+        """
+        with self._lock:
+            value, expires = self._cache.get(name, (None, 0))
+            if time.monotonic() < expires:
+                return value
+            try:
+                for backend in self.backends:
+                    new_value = backend.lookup(name)
+                    if new_value is not None:
+                        break
+            except Exception as e:
+                if value is None:
+                    raise
+                logging.warning('Failed to refresh {}, keeping {}: {}'.format(name, value, e))
+                new_value = value
+            self._cache[name] = (new_value, time.monotonic() + self.ttl)
+            return new_value
+
+    def refresh(self):
+        """Forgets all the discovered settings."""
+        with self._lock:
+            self._cache.clear()
+
+    @property
+    def traefik_network(self):
+        """str: Name of the overlay network used by traefik for ingress."""
+        return self.get('traefik_network')
+
+    @property
+    def dashboard_url(self):
+        """str: Dashboard's public url."""
+        return self.get('dashboard_url')
+
+    @property
+    def girder_url(self):
+        """str: Girder's public url."""
+        return self.get('girder_url')
+
+    @property
+    def registry_url(self):
+        """str: Docker Registry's public url."""
+        return self.get('registry_url')
+
+
+DEPLOYMENT = Deployment()
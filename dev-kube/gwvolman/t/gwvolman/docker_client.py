@@ -0,0 +1,90 @@
+"""A docker client shared by the tasks of a worker, logged in to the registry.
+
+Creating a client and logging in to the registry used to be done by every
+launch. The shared client keeps its connections to the docker daemon, and its
+registry credentials, which docker forwards when it pulls or creates services.
+The login is renewed when it's older than REGISTRY_LOGIN_TTL, when the
+registry changes, or when the daemon reports an authentication failure.
+"""
+import logging
+import os
+import threading
+import time
+
+from .utils import REGISTRY_USER, REGISTRY_PASS, DEPLOYMENT
+
+# Seconds after which the worker logs in to the registry again
+REGISTRY_LOGIN_TTL = float(os.environ.get('REGISTRY_LOGIN_TTL', 3600))
+
+
+def is_auth_error(error):
+    """Tells whether a docker error was caused by missing or expired credentials."""
+    message = str(error).lower()
+    return getattr(error, 'status_code', None) == 401 or \
+        any(_ in message for _ in ('unauthorized', 'authentication required',
+                                   'access denied'))
+
+
+class SharedDockerClient(object):
+    """A docker client for all threads of a worker process.
+
+    The client is created on first use, and again in a forked process, since
+    connections to the daemon can't be shared with the parent.
+    """
+
+    def __init__(self, login_ttl=REGISTRY_LOGIN_TTL):
+        self.login_ttl = login_ttl
+        self._client = None
+        self._pid = None
+        self._registry = None
+        self._login_expires = 0
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        if self._client is None or self._pid != os.getpid():
+            import docker
+            self._client = docker.from_env(version='1.28')
+            self._pid = os.getpid()
+            self._registry = None
+        return self._client
+
+    def get(self, login=True):
+        """
+        Returns the client, logged in to the registry unless `login` is False.
+
+        :rtype: docker.DockerClient
+        """
+        with self._lock:
+            cli = self._get_client()
+            registry = DEPLOYMENT.registry_url
+            if login and (self._registry != registry or
+                          time.monotonic() > self._login_expires):
+                cli.login(username=REGISTRY_USER, password=REGISTRY_PASS,
+                          registry=registry, reauth=self._registry is not None)
+                self._registry = registry
+                self._login_expires = time.monotonic() + self.login_ttl
+            return cli
+
+    def invalidate_login(self):
+        """Makes the next `get` log in again."""
+        with self._lock:
+            self._login_expires = 0
+
+    def call(self, func, *args, login=True, **kwargs):
+        """
+        Calls `func` with the client as its first argument, logged in to the
+        registry unless `login` is False. If the call fails because of the
+        credentials, they are renewed and the call is retried once.
+        """
+        import docker
+        try:
+            return func(self.get(login=login), *args, **kwargs)
+        except docker.errors.APIError as e:
+            if not is_auth_error(e):
+                raise
+            logging.info('Logging in to the registry again after: {}'.format(e))
+            self.invalidate_login()
+            return func(self.get(), *args, **kwargs)
+
+
+DOCKER_CLIENT = SharedDockerClient()
@@ -0,0 +1,124 @@
+"""Inventory of the images present on each node."""
+import logging
+import os
+import threading
+import time
+
+# Seconds after which the inventory is refreshed
+IMAGE_INVENTORY_TTL = float(os.environ.get('IMAGE_INVENTORY_TTL', 60))
+
+
+def _image_names(image):
+    """
+    Returns the names under which a node may list an image reference, which
+    defaults to the `latest` tag when it has neither a tag nor a digest.
+    """
+    names = {image}
+    if '@' not in image and ':' not in image.rsplit('/', 1)[-1]:
+        names.add(image + ':latest')
+    return names
+
+
+def list_kubernetes_node_images():
+    """
+    :return: The names of the images on each node of the cluster, by the
+     node's `kubernetes.io/hostname` label
+    :rtype: dict
+    """
+    from kubernetes import client, config
+    config.load_incluster_config()
+    inventory = dict()
+    for node in client.CoreV1Api().list_node().items:
+        hostname = (node.metadata.labels or {}).get('kubernetes.io/hostname',
+                                                    node.metadata.name)
+        names = set()
+        for image in node.status.images or []:
+            names.update(image.names or [])
+        inventory[hostname] = names
+    return inventory
+
+
+def list_docker_node_images(cli=None):
+    """
+    :return: The tags and digests of the images of the worker's own swarm
+     node; other nodes' images aren't visible through the swarm API
+    :rtype: dict
+    """
+    if cli is None:
+        from .docker_client import DOCKER_CLIENT
+        cli = DOCKER_CLIENT.get(login=False)
+    names = set()
+    for image in cli.images.list():
+        names.update(image.tags)
+        names.update(image.attrs.get('RepoDigests') or [])
+    return {cli.info()['Swarm']['NodeID']: names}
+
+
+class NodeImageInventory(object):
+    """Which images are present on which nodes.
+
+    The inventory is read with `lister` on first use and again once it's older
+    than `ttl` seconds. It's shared by all threads of the worker.
+    """
+
+    def __init__(self, lister, ttl=IMAGE_INVENTORY_TTL):
+        self.lister = lister
+        self.ttl = ttl
+        self._inventory = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        inventory = self.lister()
+        with self._lock:
+            self._inventory = inventory
+            self._expires = time.monotonic() + self.ttl
+        return inventory
+
+    def get(self):
+        with self._lock:
+            inventory, expires = self._inventory, self._expires
+        if inventory is None or time.monotonic() > expires:
+            try:
+                inventory = self.refresh()
+            except Exception as e:
+                if inventory is None:
+                    raise
+                logging.warning('Failed to refresh the image inventory: {}'.format(e))
+        return inventory
+
+    def nodes_with_image(self, image):
+        """
+        :param image: The image reference, e.g. `registry/imageId`
+        :type image: str
+        :return: The nodes which hold the image
+        :rtype: list
+        """
+        names = _image_names(image)
+        return sorted(node for node, images in self.get().items() if names & images)
+
+    def has_image(self, node, image):
+        return bool(_image_names(image) & self.get().get(node, set()))
+
+
+def pull_image(cli, image):
+    """
+    Pulls an image with the node's docker daemon, unless it's already there.
+
+    :return: True if the image was pulled
+    :rtype: bool
+    """
+    import docker
+    try:
+        cli.images.get(image)
+        return False
+    except docker.errors.ImageNotFound:
+        pass
+    start = time.monotonic()
+    cli.images.pull(image)
+    logging.info('Pulled {} in {:.1f}s'.format(image, time.monotonic() - start))
+    return True
+
+
+# The worker's own node, for the docker flavor
+LOCAL_DOCKER_INVENTORY = NodeImageInventory(list_docker_node_images)
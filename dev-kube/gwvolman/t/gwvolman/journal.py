@@ -0,0 +1,174 @@
+"""Checkpointing of publish jobs."""
+import hashlib
+import logging
+import threading
+
+import girder_client
+import requests
+
+from .cache import PersistentCache
+
+journals = PersistentCache('publish_journals')
+# Private folder of the user holding one item per unfinished publish journal
+JOURNAL_FOLDER = '.publish_journals'
+# Failing to reach Girder only means that the objects are uploaded again
+GIRDER_ERRORS = (girder_client.HttpError, requests.RequestException)
+
+
+class GirderJournalStore(object):
+    """Keeps journals in Girder, as items of a hidden folder of the user.
+
+    Unlike the worker's cache, which is lost when the worker's container is
+    replaced and isn't seen by the other nodes, Girder is reachable from
+    whichever worker runs the retry. Each journal is an item whose metadata
+    has a field per entry, so recording an object only sends that object, and
+    the item is deleted once the publish succeeds. Failing to reach Girder is
+    never fatal: the objects are uploaded again.
+    """
+
+    def __init__(self, gc, user_id):
+        self.gc = gc
+        self.user_id = user_id
+        self._folder_id = None
+        self._item_ids = dict()
+        self._lock = threading.Lock()
+
+    def _folder(self):
+        if self._folder_id is None:
+            folder = self.gc.createFolder(self.user_id, JOURNAL_FOLDER, parentType='user',
+                                          reuseExisting=True, public=False)
+            self._folder_id = folder['_id']
+        return self._folder_id
+
+    def _item(self, key, create=False):
+        """Returns the id of the journal's item, or None if there's none."""
+        with self._lock:
+            if key not in self._item_ids:
+                if create:
+                    item = self.gc.createItem(self._folder(), key, reuseExisting=True)
+                else:
+                    item = next(iter(self.gc.listItem(self._folder(), name=key)), None)
+                    if item is None:
+                        return None
+                self._item_ids[key] = item['_id']
+            return self._item_ids[key]
+
+    def get(self, key):
+        try:
+            item_id = self._item(key)
+            if item_id is None:
+                return dict()
+            meta = self.gc.getItem(item_id).get('meta') or dict()
+            return {value['name']: value for value in meta.values()}
+        except GIRDER_ERRORS as e:
+            logging.warning('Failed to read the publish journal from Girder: {}'.format(e))
+            return dict()
+
+    def add(self, key, name, entry):
+        # Metadata keys can't contain dots
+        field = hashlib.sha1(name.encode('utf-8')).hexdigest()
+        try:
+            self.gc.addMetadataToItem(self._item(key, create=True),
+                                      {field: dict(entry, name=name)})
+        except GIRDER_ERRORS as e:
+            logging.warning('Failed to record {} in Girder: {}'.format(name, e))
+
+    def delete(self, key):
+        try:
+            item_id = self._item(key)
+            if item_id is not None:
+                self.gc.delete('/item/' + item_id)
+            with self._lock:
+                self._item_ids.pop(key, None)
+        except GIRDER_ERRORS as e:
+            logging.warning('Failed to remove the publish journal from Girder: {}'.format(e))
+
+
+class PublishJournal(object):
+    """Records the objects that a publish job has created on DataONE.
+
+    A journal is identified by the Tale, the member node, the DataONE user and
+    the license, so a retry of the same publish finds the entries written by
+    the failed attempt and can reuse their pids instead of uploading the
+    objects again. Entries are written as soon as an object has been created
+    and the journal is removed once the resource map is uploaded.
+
+    The journal is kept in the worker's cache and, if `remote` is given, in
+    Girder (see GirderJournalStore), so that a retry on another node or after
+    the worker restarts can resume too.
+    """
+
+    def __init__(self, tale_id, mn_base_url, user_id, license_id, store=None,
+                 remote=None):
+        key = '\n'.join(str(_) for _ in (tale_id, mn_base_url, user_id, license_id))
+        self.key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        self.store = store or journals
+        self.remote = remote
+        self._entries = dict()
+        if self.remote is not None:
+            for name, entry in self.remote.get(self.key).items():
+                self._entries[name] = {_: entry.get(_) for _ in ('pid', 'size', 'md5')}
+        self._entries.update(self.store.get(self.key) or dict())
+        self._lock = threading.Lock()
+        if self._entries:
+            logging.info('Resuming publish, {} objects already on {}'.format(
+                len(self._entries), mn_base_url))
+
+    def lookup(self, name, md5=None):
+        """
+        Returns the entry of an object created by an earlier attempt.
+
+        :param name: The name of the object in the journal
+        :param md5: If given, the object is only reused if its md5 matches
+        :type name: str
+        :type md5: str
+        :return: The journal entry, with `pid`, `size` and `md5` fields
+        :rtype: dict or None
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+        if entry is None or (md5 is not None and entry.get('md5') != md5):
+            return None
+        logging.debug('Skipping {}, already uploaded as {}'.format(name, entry['pid']))
+        return entry
+
+    def record(self, name, pid, size=None, md5=None):
+        """
+        Adds an object that has been successfully created on the member node.
+
+        :param name: The name of the object in the journal
+        :param pid: The pid of the object
+        :param size: The size of the object in bytes
+        :param md5: The md5 of the object
+        :type name: str
+        :type pid: str
+        :type size: int
+        :type md5: str
+        """
+        entry = {'pid': pid, 'size': size, 'md5': md5}
+        with self._lock:
+            self._entries[name] = entry
+            self.store.set(self.key, self._entries)
+        if self.remote is not None:
+            self.remote.add(self.key, name, entry)
+
+    def clear(self):
+        """Removes the journal once the package is complete."""
+        with self._lock:
+            self._entries = dict()
+            self.store.delete(self.key)
+        if self.remote is not None:
+            self.remote.delete(self.key)
+
+
+def file_entry_name(file_object):
+    """
+    Returns the journal name of a Girder file. It includes the size and
+    modification time so that a file changed between attempts is uploaded again.
+
+    :param file_object: The Girder file
+    :type file_object: girder.models.file
+    :rtype: str
+    """
+    return 'file:{}:{}:{}'.format(file_object['_id'], file_object.get('size'),
+                                  file_object.get('updated', file_object.get('created')))
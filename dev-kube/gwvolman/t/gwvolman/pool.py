@@ -0,0 +1,273 @@
+"""Warm pool of pre-started Tale containers.
+
+Each node keeps a few idle containers running for the images listed in
+WARM_POOL_SIZES, so that launching a Tale doesn't wait for the image to be
+pulled and the server to start. A pooled container's mount points are bind
+mounts of empty directories on the node (its "slot"), mounted with slave
+propagation. Binding the container to an instance mounts the instance's
+volume onto the slot, which makes the Tale's files appear in the running
+container, and hands out the container's route.
+
+Pooled services are labelled with their state. A container is claimed by
+updating the labels of its service, which the swarm only accepts if the
+service hasn't changed since it was read, so two launches never bind the same
+container.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+
+from .cache import PersistentCache, CACHE_DIR
+from .utils import \
+    HOSTDIR, PooledContainer, \
+    ContainerConfig, new_user, _render_container_command, _create_service, \
+    _instance_url
+from .constants import MOUNTPOINTS
+
+# Number of idle containers kept on each node per image id, e.g. {"<imageId>": 2}
+WARM_POOL_SIZES = json.loads(os.environ.get('WARM_POOL_SIZES', '{}'))
+# Seconds after which an idle pooled container is replaced by a fresh one
+WARM_POOL_IDLE_TIMEOUT = float(os.environ.get('WARM_POOL_IDLE_TIMEOUT', 6 * 3600))
+# Directory on the nodes holding the slots of the pooled containers
+WARM_POOL_DIR = os.environ.get('WARM_POOL_DIR', '/var/lib/wholetale/pool')
+
+IMAGE_LABEL = 'wholetale.pool.image'
+NODE_LABEL = 'wholetale.pool.node'
+STATE_LABEL = 'wholetale.pool.state'
+CONFIG_LABEL = 'wholetale.pool.config'
+PATH_LABEL = 'wholetale.pool.path'
+CREATED_LABEL = 'wholetale.pool.created'
+IDLE = 'idle'
+BOUND = 'bound'
+
+# The container config last used by this node's workers to launch each image,
+# used to refill the node's pool
+pool_configs = PersistentCache('pool_configs')
+
+
+def config_hash(container_config):
+    """A pooled container can only be used for launches with the same config."""
+    config = json.dumps(container_config._asdict(), sort_keys=True)
+    return hashlib.sha1(config.encode('utf-8')).hexdigest()
+
+
+def _load_config(config):
+    """Returns the ContainerConfig stored as JSON in pool_configs."""
+    return ContainerConfig(**dict(config, environment=tuple(config['environment'] or ())))
+
+
+def image_id(container_config):
+    return container_config.image.rsplit('/', 1)[-1]
+
+
+def _get_docker_client():
+    from .docker_client import DOCKER_CLIENT
+    return DOCKER_CLIENT.get()
+
+
+def _node_id(cli):
+    return cli.info()['Swarm']['NodeID']
+
+
+def _slot_path(host):
+    """The slot of a container, as seen from the worker."""
+    return HOSTDIR + os.path.join(WARM_POOL_DIR, host)
+
+
+def _pooled_services(cli, node_id, state=None):
+    labels = ['{}={}'.format(NODE_LABEL, node_id)]
+    if state is not None:
+        labels.append('{}={}'.format(STATE_LABEL, state))
+    return cli.services.list(filters={'label': labels})
+
+
+def _is_running(service):
+    return any(task['Status']['State'] == 'running'
+               for task in service.tasks(filters={'desired-state': 'running'}))
+
+
+def _start_pooled_container(node_id, container_config):
+    import docker
+    from .docker_client import DOCKER_CLIENT
+    host = 'tmp-{}'.format(new_user(12).lower())
+    slot = _slot_path(host)
+    for path in MOUNTPOINTS:
+        os.makedirs(os.path.join(slot, path), exist_ok=True)
+    # Mounts on the slot must reach the container, whatever the propagation
+    # of the node's root filesystem
+    subprocess.check_call(['mount', '--bind', slot, slot])
+    subprocess.check_call(['mount', '--make-shared', slot])
+
+    rendered_command, rendered_url_path = _render_container_command(container_config)
+    mounts = [
+        docker.types.Mount(type='bind',
+                           source=os.path.join(WARM_POOL_DIR, host, path),
+                           target=os.path.join(container_config.target_mount, path),
+                           propagation='rslave')
+        for path in MOUNTPOINTS]
+    labels = {
+        IMAGE_LABEL: image_id(container_config),
+        NODE_LABEL: node_id,
+        STATE_LABEL: IDLE,
+        CONFIG_LABEL: config_hash(container_config),
+        PATH_LABEL: rendered_url_path,
+        CREATED_LABEL: str(int(time.time())),
+    }
+    logging.info('Starting pooled container {} for {}'.format(host, container_config.image))
+    return DOCKER_CLIENT.call(_create_service, host, container_config, rendered_command,
+                              mounts, ['node.id == {}'.format(node_id)], labels)
+
+
+def _release_slot(host):
+    """Unmounts and removes the slot of a container that no longer exists."""
+    slot = _slot_path(host)
+    for path in MOUNTPOINTS:
+        subprocess.call(['umount', '-l', os.path.join(slot, path)])
+    subprocess.call(['umount', '-l', slot])
+    for path in MOUNTPOINTS:
+        try:
+            os.rmdir(os.path.join(slot, path))
+        except OSError:
+            pass
+    try:
+        os.rmdir(slot)
+    except OSError as e:
+        logging.warning('Failed to remove pool slot {}: {}'.format(slot, e))
+
+
+def claim_pooled_container(cli, node_id, container_config):
+    """
+    Claims an idle, running container of the node's pool that was started with
+    the same config.
+
+    :return: The claimed container, or None if the pool has none
+    :rtype: PooledContainer
+    """
+    import docker
+    wanted = config_hash(container_config)
+    for service in _pooled_services(cli, node_id, IDLE):
+        labels = dict(service.attrs['Spec']['Labels'])
+        if labels.get(CONFIG_LABEL) != wanted or not _is_running(service):
+            continue
+        labels[STATE_LABEL] = BOUND
+        try:
+            # Fails if another launch claimed the service since it was listed
+            cli.api.update_service(service.id, service.version, labels=labels,
+                                   fetch_current_spec=True)
+        except docker.errors.APIError as e:
+            logging.debug('Failed to claim {}: {}'.format(service.name, e))
+            continue
+        return PooledContainer(id=service.id, path=labels[PATH_LABEL], host=service.name)
+    return None
+
+
+def bind_pooled_container(pooled, volumeName):
+    """Mounts the instance's volume onto the pooled container's slot."""
+    source_mount = HOSTDIR + '/var/lib/docker/volumes/{}/_data'.format(volumeName)
+    slot = _slot_path(pooled.host)
+    for path in MOUNTPOINTS:
+        subprocess.check_call(['mount', '--bind', os.path.join(source_mount, path),
+                               os.path.join(slot, path)])
+
+
+def launch_from_pool(volumeName, nodeId, container_config):
+    """
+    Binds a pooled container to the instance, if the image has a warm pool.
+    The pool is refilled in the background.
+
+    :return: The service and its attributes, as returned by _launch_container,
+     or None if no container was available
+    :rtype: tuple
+    """
+    image = image_id(container_config)
+    if not WARM_POOL_SIZES.get(image):
+        return None
+    pool_configs.set(image, container_config._asdict())
+
+    cli = _get_docker_client()
+    if nodeId != _node_id(cli):
+        # The volume can only be bound by a worker on the node that holds it
+        return None
+    pooled = claim_pooled_container(cli, nodeId, container_config)
+    if pooled is not None:
+        try:
+            bind_pooled_container(pooled, volumeName)
+        except subprocess.CalledProcessError:
+            # Don't leave a half bound container running
+            cli.services.get(pooled.id).remove()
+            _release_slot(pooled.host)
+            raise
+        logging.info('Launched {} from the warm pool'.format(pooled.host))
+    refill_pool_async()
+    if pooled is None:
+        return None
+    return cli.services.get(pooled.id), {'url': _instance_url(pooled.host, pooled.path)}
+
+
+def refill_pool():
+    """
+    Maintains the warm pool of the worker's node. Idle containers past
+    WARM_POOL_IDLE_TIMEOUT, or started for an image or config that's no longer
+    pooled, are removed, and so are the slots of removed containers. Each image
+    is then topped up to its size, with the config it was last launched with.
+
+    :return: The number of containers started and removed
+    :rtype: dict
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(os.path.join(CACHE_DIR, 'pool.lock'), 'w') as lock:
+        # Only one refill at a time for all the worker's processes
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        cli = _get_docker_client()
+        node_id = _node_id(cli)
+        started = removed = 0
+
+        idle = dict()
+        alive = set()
+        for service in _pooled_services(cli, node_id):
+            labels = service.attrs['Spec']['Labels']
+            if labels.get(STATE_LABEL) != IDLE:
+                alive.add(service.name)
+                continue
+            image = labels.get(IMAGE_LABEL)
+            config = pool_configs.get(image)
+            expired = time.time() - int(labels.get(CREATED_LABEL, 0)) > WARM_POOL_IDLE_TIMEOUT
+            stale = config is None or \
+                labels.get(CONFIG_LABEL) != config_hash(_load_config(config))
+            if expired or stale or not WARM_POOL_SIZES.get(image):
+                logging.info('Evicting pooled container {}'.format(service.name))
+                service.remove()
+                removed += 1
+            else:
+                idle[image] = idle.get(image, 0) + 1
+                alive.add(service.name)
+
+        pool_dir = HOSTDIR + WARM_POOL_DIR
+        for host in os.listdir(pool_dir) if os.path.isdir(pool_dir) else []:
+            if host not in alive:
+                _release_slot(host)
+
+        for image, size in WARM_POOL_SIZES.items():
+            config = pool_configs.get(image)
+            if config is None:
+                # The cache is local to the node, so the image is only pooled once a
+                # launch of it has been handled by a worker on this node
+                continue
+            for _ in range(size - idle.get(image, 0)):
+                _start_pooled_container(node_id, _load_config(config))
+                started += 1
+        return {'started': started, 'removed': removed}
+
+
+def refill_pool_async():
+    def refill():
+        try:
+            refill_pool()
+        except Exception:
+            logging.exception('Failed to refill the warm pool')
+    threading.Thread(target=refill, daemon=True).start()
@@ -0,0 +1,78 @@
+"""Progress reporting and timing of multi-stage jobs."""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+
+class JobProgress(object):
+    """Reports the progress of a Girder job and times each of its stages.
+
+    The job's progress advances by one for each completed stage, or for each
+    step of stages made of many steps (e.g. one per uploaded file). Timings and
+    any statistics added to a stage are kept, so that they can be returned as a
+    machine-readable summary in the job result. It's safe to report steps from
+    several threads.
+    """
+
+    def __init__(self, job_manager=None, total=0):
+        self.job_manager = job_manager
+        self.total = total
+        self.current = 0
+        self.stages = dict()
+        # Other statistics about the job to include in its summary
+        self.info = dict()
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def update(self, message, advance=1):
+        """
+        Advances the job's progress and sets its status message.
+
+        :param message: The message shown with the job
+        :param advance: The number of steps completed since the last update
+        :type message: str
+        :type advance: int
+        """
+        with self._lock:
+            self.current += advance
+            self.total = max(self.total, self.current)
+            if self.job_manager is not None:
+                self.job_manager.updateProgress(
+                    message=message, total=self.total, current=self.current)
+        logging.debug('[{}/{}] {}'.format(self.current, self.total, message))
+
+    @contextmanager
+    def stage(self, name, message, steps=False):
+        """
+        Times the enclosed block as the stage `name`. The yielded dict is stored
+        in the summary and can be used to add statistics about the stage.
+
+        :param name: The name of the stage in the summary
+        :param message: The message shown while the stage runs
+        :param steps: True if the stage reports its own steps, in which case
+         completing it doesn't advance the progress
+        :type name: str
+        :type message: str
+        :type steps: bool
+        """
+        record = self.stages[name] = dict()
+        self.update(message, advance=0)
+        start = time.monotonic()
+        try:
+            yield record
+        finally:
+            record['seconds'] = round(time.monotonic() - start, 3)
+            if not steps:
+                self.update(message)
+
+    def summary(self):
+        """
+        :return: The duration of the job, the statistics of each stage and any
+         other information about the job
+        :rtype: dict
+        """
+        summary = dict(self.info)
+        summary.update({'seconds': round(time.monotonic() - self._start, 3),
+                        'stages': dict(self.stages)})
+        return summary
@@ -1,12 +1,12 @@
 import io
+import hashlib
 import tempfile
 import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-try:
-    from urllib.request import urlopen
-except ImportError:
-    from urllib2 import urlopen
-from shutil import copyfileobj
 import uuid
 import requests
 import yaml as yaml
@@ -19,24 +19,63 @@ from d1_common.types.exceptions import DataONEException
 
 from .utils import \
     check_pid, \
-    get_file_item, \
     compute_md5, \
+    spool_and_hash, \
+    lookup_file_md5, \
+    store_file_md5, \
+    IteratorStream, \
     extract_user_id, \
     filter_items, \
-    get_dataone_package_url
+    prefetch_item_metadata, \
+    get_dataone_package_url, \
+    get_rate_limiter, \
+    get_remote_md5, \
+    get_environment_tarball, \
+    UPLOAD_WORKERS, \
+    EXTERNAL_FETCH_WORKERS, \
+    DATAONE_POOL_SIZE, \
+    DATAONE_CLIENT_CACHE_SIZE, \
+    DEDUP_ARTIFACTS
+
+from .cache import PersistentCache
+
+from .progress import JobProgress
+
+from .journal import \
+    PublishJournal, \
+    GirderJournalStore, \
+    file_entry_name
 
 from .dataone_metadata import \
     generate_system_metadata, \
-    create_minimum_eml, \
+    populate_sys_meta, \
+    write_minimum_eml, \
     create_resource_map
 
 from .constants import \
     ExtraFileNames, \
     license_files, \
-    GIRDER_API_URL, \
+    get_girder_api_url, \
     API_VERSION
 
 
+def _eml_content_md5(eml_doc, eml_pid):
+    """
+    Returns the md5 of an EML document with its pid left out, which identifies
+    the same document generated again under another pid.
+    """
+    eml_doc.seek(0)
+    md5 = hashlib.md5()
+    # The pid is only set on the root element, at the start of the document
+    md5.update(eml_doc.read(65536).replace(eml_pid.encode('utf-8'), b'', 1))
+    while True:
+        buf = eml_doc.read(65536)
+        if not buf:
+            break
+        md5.update(buf)
+    return md5.hexdigest()
+
+
 def create_upload_eml(tale,
                       client,
                       user,
@@ -44,7 +83,9 @@ def create_upload_eml(tale,
                       license_id,
                       user_id,
                       file_sizes,
-                      gc):
+                      gc,
+                      metadata=None,
+                      journal=None):
     """
     Creates the EML metadata document along with an additional metadata document
     and uploads them both to DataONE. A pid is created for the EML document, and is
@@ -60,6 +101,9 @@ def create_upload_eml(tale,
      (like tale.yml) .The size needs to be in the EML record so pass them
       in here. The size should be described in bytes
     :param gc: The girder client
+    :param metadata: The prefetched item metadata, see prefetch_item_metadata
+    :param journal: The journal of the publish job, used to skip the upload if
+     an earlier attempt already created the same document
     :type tale: wholetale.models.tale
     :type client: MemberNodeClient_2_0
     :type user: girder.models.user
@@ -67,105 +111,251 @@ def create_upload_eml(tale,
     :type license_id: str
     :type user_id: str
     :type file_sizes: dict
+    :type metadata: dict
+    :type journal: PublishJournal
     :return: pid of the EML document
     :rtype: str
+    :raises ValueError: If the EML document can't be created, e.g. when the
+     user has no name or email
     """
 
     # Create the EML metadata
     eml_pid = str(uuid.uuid4())
-    eml_doc = create_minimum_eml(tale,
-                                 user,
-                                 item_ids,
-                                 eml_pid,
-                                 file_sizes,
-                                 license_id,
-                                 user_id,
-                                 gc)
-    # Create the metadata describing the EML document
-    meta = generate_system_metadata(pid=eml_pid,
-                                    format_id='eml://ecoinformatics.org/eml-2.1.1',
-                                    file_object=eml_doc,
-                                    name='science_metadata.xml',
-                                    rights_holder=user_id)
-    # meta is type d1_common.types.generated.dataoneTypes_v2_0.SystemMetadata
-    # Upload the EML document with its metadata
-    upload_file(client=client,
-                pid=eml_pid,
-                file_object=io.BytesIO(eml_doc),
-                system_metadata=meta)
+    with tempfile.TemporaryFile() as eml_doc:
+        # The EML is written to disk as it's generated, it can be large for big Tales
+        error = write_minimum_eml(eml_doc,
+                                  tale,
+                                  user,
+                                  item_ids,
+                                  eml_pid,
+                                  file_sizes,
+                                  license_id,
+                                  user_id,
+                                  gc,
+                                  metadata)
+        if error is not None:
+            # Without the EML there's no package to publish
+            raise ValueError('Failed to create the EML record. {}'.format(error))
+        size = eml_doc.tell()
+
+        # The EML embeds its own pid, so earlier attempts are matched on the
+        # rest of the document
+        entry_name = 'eml:' + _eml_content_md5(eml_doc, eml_pid)
+        if journal is not None:
+            entry = journal.lookup(entry_name)
+            if entry is not None:
+                return entry['pid']
+
+        eml_doc.seek(0)
+        md5 = compute_md5(eml_doc).hexdigest()
+        eml_doc.seek(0)
+        # Create the metadata describing the EML document
+        meta = populate_sys_meta(eml_pid,
+                                 'eml://ecoinformatics.org/eml-2.1.1',
+                                 size,
+                                 md5,
+                                 'science_metadata.xml',
+                                 user_id)
+        # meta is type d1_common.types.generated.dataoneTypes_v2_0.SystemMetadata
+        # Upload the EML document with its metadata
+        error = upload_file(client=client,
+                            pid=eml_pid,
+                            file_object=eml_doc,
+                            system_metadata=meta)
+    if journal is not None and error is None:
+        journal.record(entry_name, eml_pid, size, md5)
     return eml_pid
 
 
-def create_external_object_structure(external_files, user, gc):
+def create_external_object_structure(external_files, user, gc, metadata=None):
     """
     Creates a JSON file that describes a remote which has the following format
      {file_name : {'url': url, 'md5': md5}
-     We'll want to compute the md5, so we have to save the file
-     temporarily.
+     The remote objects are downloaded concurrently and hashed as they
+     arrive; each distinct url is only fetched once.
 
     :param external_files: A list of files that exist outside WholeTale
     :param user: The user publishing the tale
     :param gc: The girder client
+    :param metadata: The prefetched item metadata, see prefetch_item_metadata
     :type external_files: list
     :type user: girder.mnodels.user
+    :type metadata: dict
     :return: A dictionary that lists each remote file with its md5
     :rtype: dict
     """
 
-    reference_file = dict()
+    if metadata is None:
+        metadata = prefetch_item_metadata(external_files, gc)
 
+    """
+    Get the underlying file object from the supplied item id.
+    We'll need the `linkUrl` field to determine where it is pointing to.
+    """
+    linked_files = list()
     for item in external_files:
+        file = metadata[item].file
+        if file is not None and file.get('linkUrl', None) is not None:
+            linked_files.append(file)
+
+    urls = list(dict.fromkeys(file['linkUrl'] for file in linked_files))
+    digests = dict()
+    if urls:
+        workers = max(1, min(EXTERNAL_FETCH_WORKERS, len(urls)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {url: executor.submit(get_remote_md5, url) for url in urls}
+            for file in linked_files:
+                url = file['linkUrl']
+                try:
+                    digests[url] = futures[url].result()
+                except requests.exceptions.RequestException:
+                    # if we fail to download the file, exit
+                    for future in futures.values():
+                        future.cancel()
+                    return 'There was a problem downloading an external file, {} ' \
+                           'located at {}.'.format(file['name'], url)
+
+    reference_file = dict()
+    for file in linked_files:
         """
-        Get the underlying file object from the supplied item id.
-        We'll need the `linkUrl` field to determine where it is pointing to.
+        Create dictionary entries for the file. We key off of the file name,
+        and store the url and md5 with it.
         """
-        file = get_file_item(item, gc)
-        if file is not None:
-            url = file.get('linkUrl', None)
-            if url is not None:
-                """
-                Create a temporary file object which will eventually hold the contents
-                of the remote object.
-                """
-                with tempfile.NamedTemporaryFile() as temp_file:
-                    try:
-                        src = urlopen(url)
-                        # Copy the response into the temporary file
-                        copyfileobj(src, temp_file)
-
-                    except requests.exceptions.HTTPError:
-                        # if we fail to download the file, exit
-                        return 'There was a problem downloading an external file, {} ' \
-                               'located at {}.'.format(file['name'], url)
-
-                    # Get the md5 of the file
-                    md5 = compute_md5(temp_file)
-                    digest = md5.hexdigest()
-
-                    """
-                    Create dictionary entries for the file. We key off of the file name,
-                    and store the url and md5 with it.
-                    """
-                    url_entry = {'url': url}
-                    md5_entry = {'md5': digest}
-                    reference_file[file['name']] = url_entry, md5_entry
+        url_entry = {'url': file['linkUrl']}
+        md5_entry = {'md5': digests[file['linkUrl']]}
+        reference_file[file['name']] = url_entry, md5_entry
 
     return reference_file
 
 
-def create_dataone_client(mn_base_url, auth_token):
+_dataone_clients = OrderedDict()
+_dataone_clients_lock = threading.Lock()
+
+
+def create_dataone_client(mn_base_url, auth_token, pool_size=DATAONE_POOL_SIZE):
     """
-    Creates and returns a member node client
+    Creates and returns a member node client. Clients are kept per member node
+    and token, so every upload of a publish, and later publishes by the same
+    user in this worker, reuse the same pool of keep-alive connections instead
+    of paying for a new TCP and TLS handshake on each request.
 
     :param mn_base_url: The url of the member node endpoint
     :param auth_token: The auth token for the user that is using the client
     Should be of the form {"headers": { "Authorization": "Bearer <TOKEN>}}
+    :param pool_size: The number of connections kept open to the member node
     :type mn_base_url: str
     :type auth_token: dict
+    :type pool_size: int
     :return: A client for communicating with a DataONE node
     :rtype: MemberNodeClient_2_0
     """
-    return MemberNodeClient_2_0(mn_base_url, **auth_token)
+    key = (mn_base_url, auth_token.get('headers', {}).get('Authorization'))
+    with _dataone_clients_lock:
+        client = _dataone_clients.get(key)
+        if client is not None:
+            _dataone_clients.move_to_end(key)
+            return client
+
+        client = MemberNodeClient_2_0(mn_base_url, **auth_token)
+        session = _get_requests_session(client)
+        if session is not None:
+            # Keep the retry policy set up by the DataONE client
+            retries = session.get_adapter(mn_base_url).max_retries
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=pool_size,
+                                                    max_retries=retries)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+        _dataone_clients[key] = client
+        while len(_dataone_clients) > DATAONE_CLIENT_CACHE_SIZE:
+            # Not closed here: a running publish may still hold the client
+            _dataone_clients.popitem(last=False)
+        return client
+
+
+def _get_requests_session(client):
+    """
+    Returns the requests session used by a DataONE client, or None if the
+    client doesn't expose one.
+    """
+    session = getattr(client, '_session', None)
+    if isinstance(session, requests.Session):
+        return session
+    return None
+
+
+def get_connection_stats(client):
+    """
+    Counts the requests sent by a DataONE client and the connections it opened
+    to send them. Each request beyond the number of connections reused an open
+    connection, saving a handshake.
+
+    :param client: The client to the DataONE member node
+    :type client: MemberNodeClient_2_0
+    :return: The number of requests and the number of connections
+    :rtype: tuple
+    """
+    num_requests = num_connections = 0
+    session = _get_requests_session(client)
+    if session is None:
+        return num_requests, num_connections
+    for adapter in set(session.adapters.values()):
+        pools = getattr(adapter, 'poolmanager', None)
+        if pools is None:
+            continue
+        for pool_key in pools.pools.keys():
+            pool = pools.pools.get(pool_key)
+            if pool is not None:
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+    return num_requests, num_connections
+
+
+# pids of LICENSE and environment objects, keyed by member node, name and md5
+published_artifacts = PersistentCache('published_artifacts')
+
+
+def _artifact_key(mn_base_url, name, md5):
+    return '{}\n{}\n{}'.format(mn_base_url, name, md5)
+
+
+def find_published_artifact(client, mn_base_url, name, md5):
+    """
+    Looks for an object with the same name and content that was uploaded to
+    the member node by an earlier publish. The object is checked to still
+    exist before it's reused.
+
+    :param client: The client to the DataONE member node
+    :param mn_base_url: The url of the member node endpoint
+    :param name: The file name of the object
+    :param md5: The md5 of the object
+    :type client: MemberNodeClient_2_0
+    :type mn_base_url: str
+    :type name: str
+    :type md5: str
+    :return: The pid of the existing object, or None
+    :rtype: str
+    """
+    key = _artifact_key(mn_base_url, name, md5)
+    pid = published_artifacts.get(key)
+    if pid is None:
+        return None
+    try:
+        client.describe(pid)
+    except DataONEException as e:
+        logging.info('Not reusing {}, {}'.format(pid, e))
+        published_artifacts.delete(key)
+        return None
+    logging.info('Reusing {} already published as {}'.format(name, pid))
+    return pid
+
+
+def record_published_artifact(mn_base_url, name, md5, pid):
+    """
+    Remembers an object uploaded to a member node, see find_published_artifact.
+    """
+    published_artifacts.set(_artifact_key(mn_base_url, name, md5), pid)
 
 
 def upload_file(client, pid, file_object, system_metadata):
@@ -190,12 +380,14 @@ def upload_file(client, pid, file_object, system_metadata):
         return 'Error uploading file to DataONE. {0}'.format(str(e))
 
 
-def create_paths_structure(item_ids, gc):
+def create_paths_structure(item_ids, gc, metadata=None):
     """
     Creates a file that lists the path that each item is located at.
     :param item_ids: A list of items that are in the tale
     :param gc: The girder client
+    :param metadata: The prefetched item metadata, see prefetch_item_metadata
     :type item_ids: list
+    :type metadata: dict
     :return: The dict representing the file structure
     :rtype: dict
     """
@@ -204,12 +396,13 @@ def create_paths_structure(item_ids, gc):
     We'll use a dict structure to hold the file contents during creation for
      convenience.
     """
+    if metadata is None:
+        metadata = prefetch_item_metadata(item_ids, gc)
+
     path_file = dict()
 
     for item_id in item_ids:
-        item = gc.getItem(item_id)
-        path = gc.get('resource/{}/path?type=item'.format(item_id))
-        path_file[item['name']] = path
+        path_file[metadata[item_id].item['name']] = metadata[item_id].path
 
     return path_file
 
@@ -255,7 +448,8 @@ def create_upload_resmap(res_pid, eml_pid, obj_pids, client, rights_holder):
     :type obj_pids: list
     :type client: MemberNodeClient_2_0
     :type rights_holder: str
-    :return: None
+    :return: None, or an error message if the upload failed
+    :rtype: str
     """
 
     res_map = create_resource_map(res_pid, eml_pid, obj_pids)
@@ -266,10 +460,10 @@ def create_upload_resmap(res_pid, eml_pid, obj_pids, client, rights_holder):
                                     name=str(),
                                     rights_holder=rights_holder)
 
-    upload_file(client=client,
-                pid=res_pid,
-                file_object=io.BytesIO(res_map),
-                system_metadata=meta)
+    return upload_file(client=client,
+                       pid=res_pid,
+                       file_object=io.BytesIO(res_map),
+                       system_metadata=meta)
 
 
 def create_upload_tale_yaml(tale,
@@ -279,7 +473,9 @@ def create_upload_tale_yaml(tale,
                             client,
                             prov_info,
                             rights_holder,
-                            gc):
+                            gc,
+                            metadata=None,
+                            journal=None):
     """
     The yaml content is represented with Python dicts, and then dumped to
      the yaml object.
@@ -292,6 +488,9 @@ def create_upload_tale_yaml(tale,
     is gathered in the UI and passed through the REST endpoint.
     :param rights_holder: The owner of this object
     :param gc: The girder client
+    :param metadata: The prefetched item metadata, see prefetch_item_metadata
+    :param journal: The journal of the publish job, used to skip the upload if
+     an earlier attempt already created the same file
     :type tale: wholetale.models.Tale
     :type remote_objects: list
     :type item_ids: list
@@ -299,6 +498,8 @@ def create_upload_tale_yaml(tale,
     :type client: MemberNodeClient_2_0
     :type prov_info: dict
     :type rights_holder: str
+    :type metadata: dict
+    :type journal: PublishJournal
     :return: The pid and the size of the file
     :rtype: tuple
     """
@@ -308,12 +509,13 @@ def create_upload_tale_yaml(tale,
 
     # Create the dict that holds the file paths
     file_paths = dict()
-    file_paths['paths'] = create_paths_structure(item_ids, gc)
+    file_paths['paths'] = create_paths_structure(item_ids, gc, metadata)
 
     # Create the dict that tracks externally defined objects, if applicable
     external_files = dict()
     if len(remote_objects) > 0:
-        external_files['external files'] = create_external_object_structure(remote_objects, user, gc)
+        external_files['external files'] = \
+            create_external_object_structure(remote_objects, user, gc, metadata)
 
     # Append all of the information together
     yaml_file = dict(tale_info)
@@ -326,6 +528,12 @@ def create_upload_tale_yaml(tale,
     # Transform the file into yaml from the dict structure
     yaml_file = yaml.dump(yaml_file, default_flow_style=False)
 
+    md5 = hashlib.md5(yaml_file.encode('utf-8')).hexdigest()
+    if journal is not None:
+        entry = journal.lookup(ExtraFileNames.tale_config, md5)
+        if entry is not None:
+            return entry['pid'], len(yaml_file)
+
     # Create a pid for the file
     pid = str(uuid.uuid4())
     # Create system metadata for the file
@@ -335,25 +543,33 @@ def create_upload_tale_yaml(tale,
                                     name=ExtraFileNames.tale_config,
                                     rights_holder=rights_holder)
     # Upload the file
-    upload_file(client=client,
-                pid=pid,
-                file_object=io.StringIO(yaml_file),
-                system_metadata=meta)
+    error = upload_file(client=client,
+                        pid=pid,
+                        file_object=io.StringIO(yaml_file),
+                        system_metadata=meta)
+    if journal is not None and error is None:
+        journal.record(ExtraFileNames.tale_config, pid, len(yaml_file), md5)
 
     # Return the pid
     return pid, len(yaml_file)
 
 
-def upload_license_file(client, license_id, rights_holder):
+def upload_license_file(client, license_id, rights_holder, journal=None, dedup_node=None):
     """
     Upload a license file to DataONE.
 
     :param client: The client that interfaces DataONE
     :param license_id: The ID of the license (see `ExtraFileNames` in constants)
     :param rights_holder: The owner of this object
+    :param journal: The journal of the publish job, used to skip the upload if
+     an earlier attempt already created the file
+    :param dedup_node: The url of the member node; if set, an identical license
+     file that was published before is referenced instead of uploading a copy
     :type client: MemberNodeClient_2_0
     :type license_id: str
     :type rights_holder: str
+    :type journal: PublishJournal
+    :type dedup_node: str
     :return: The pid and size of the license file
     """
     # Holds the license text
@@ -371,6 +587,17 @@ def upload_license_file(client, license_id, rights_holder):
         logging.warning('Failed to open license file')
         return None, 0
 
+    md5 = hashlib.md5(license_text.encode('utf-8')).hexdigest()
+    if journal is not None:
+        entry = journal.lookup(ExtraFileNames.license_filename, md5)
+        if entry is not None:
+            return entry['pid'], license_length
+    if dedup_node is not None:
+        pid = find_published_artifact(client, dedup_node,
+                                      ExtraFileNames.license_filename, md5)
+        if pid is not None:
+            return pid, license_length
+
     # Create a pid for the file
     pid = str(uuid.uuid4())
     # Create system metadata for the file
@@ -380,13 +607,17 @@ def upload_license_file(client, license_id, rights_holder):
                                     name=ExtraFileNames.license_filename,
                                     rights_holder=rights_holder)
     # Upload the file
-    upload_file(client=client, pid=pid, file_object=license_text, system_metadata=meta)
+    error = upload_file(client=client, pid=pid, file_object=license_text, system_metadata=meta)
+    if journal is not None and error is None:
+        journal.record(ExtraFileNames.license_filename, pid, license_length, md5)
+    if dedup_node is not None and error is None:
+        record_published_artifact(dedup_node, ExtraFileNames.license_filename, md5, pid)
 
     # Return the pid and length of the file
     return pid, license_length
 
 
-def create_upload_object_metadata(client, file_object, rights_holder, gc):
+def create_upload_object_metadata(client, file_object, rights_holder, gc, journal=None):
     """
     Takes a file that exists on the filesystem and
         1. Creates metadata describing it
@@ -398,35 +629,139 @@ def create_upload_object_metadata(client, file_object, rights_holder, gc):
     :param file_object: The file object that will be uploaded
     :param rights_holder: The owner of this object
     :param gc: The girder client
+    :param journal: The journal of the publish job, used to skip the upload if
+     an earlier attempt already created the object
     :type client: MemberNodeClient_2_0
     :type file_object: girder.models.file
     :type rights_holder: str
+    :type journal: PublishJournal
     :return: The pid of the object
     :rtype: str
     """
 
+    if journal is not None:
+        entry = journal.lookup(file_entry_name(file_object))
+        if entry is not None:
+            return entry['pid']
+
     # PID for the metadata object
     pid = str(uuid.uuid4())
-    with tempfile.NamedTemporaryFile() as temp_file:
-        gc.downloadFile(file_object['_id'], temp_file.name)
-        temp_file.seek(0)
-        meta = generate_system_metadata(pid,
-                                        format_id=file_object['mimeType'],
-                                        file_object=temp_file,
-                                        name=file_object['name'],
-                                        is_file=True,
-                                        rights_holder=rights_holder,
-                                        size=file_object['size'])
-        temp_file.seek(0)
-        upload_file(client=client,
-                    pid=pid,
-                    file_object=temp_file.read(),
-                    system_metadata=meta)
-        logging.info('Uploaded file to DataONE, PID {}'.format(pid))
+    chunks = gc.downloadFileAsIterator(file_object['_id'])
+    digest = lookup_file_md5(file_object)
+    size = file_object['size']
+    if digest is not None:
+        # The checksum is already known, so stream straight from Girder
+        meta = populate_sys_meta(pid,
+                                 file_object['mimeType'],
+                                 size,
+                                 digest,
+                                 file_object['name'],
+                                 rights_holder)
+        error = upload_file(client=client,
+                            pid=pid,
+                            file_object=IteratorStream(chunks, size),
+                            system_metadata=meta)
+    else:
+        """
+        Spool the download to disk, hashing it on the way, and upload from the open
+        handle. The system metadata needs the checksum before the upload starts, but
+        this way the file is read from Girder once and never held in memory.
+        """
+        with tempfile.TemporaryFile() as temp_file:
+            md5, size = spool_and_hash(chunks, temp_file)
+            digest = md5.hexdigest()
+            store_file_md5(file_object, digest)
+            meta = populate_sys_meta(pid,
+                                     file_object['mimeType'],
+                                     size,
+                                     digest,
+                                     file_object['name'],
+                                     rights_holder)
+            error = upload_file(client=client,
+                                pid=pid,
+                                file_object=temp_file,
+                                system_metadata=meta)
+    if journal is not None and error is None:
+        journal.record(file_entry_name(file_object), pid, size, digest)
+    logging.info('Uploaded file to DataONE, PID {}'.format(pid))
     return pid
 
 
-def create_upload_repository(tale, client, rights_holder, gc):
+def upload_local_files(client, files, rights_holder, gc, mn_base_url,
+                       max_workers=UPLOAD_WORKERS, journal=None, on_uploaded=None):
+    """
+    Uploads a list of Girder files to DataONE using a bounded pool of workers,
+    so that downloads from Girder overlap with object creation on the member
+    node. Object creation is throttled by the member node's rate limiter; files
+    that the journal already has are skipped without waiting for it.
+
+    :param client: The client to the DataONE member node
+    :param files: The file objects that will be uploaded
+    :param rights_holder: The owner of the objects
+    :param gc: The girder client
+    :param mn_base_url: The url of the member node endpoint
+    :param max_workers: The maximum number of concurrent uploads
+    :param journal: The journal of the publish job
+    :param on_uploaded: Called from the worker threads with the file object and
+     the number of seconds its upload took, once each file is done. The number
+     of seconds is None for files skipped because the journal has them
+    :type client: MemberNodeClient_2_0
+    :type files: list
+    :type rights_holder: str
+    :type mn_base_url: str
+    :type max_workers: int
+    :type journal: PublishJournal
+    :type on_uploaded: callable
+    :return: The pids of the objects, in the same order as `files`
+    :rtype: list
+    """
+    limiter = get_rate_limiter(mn_base_url)
+
+    def upload(file_object):
+        entry = None
+        if journal is not None:
+            entry = journal.lookup(file_entry_name(file_object))
+        if entry is not None:
+            # Uploaded by an earlier attempt, so it doesn't count against the limit
+            if on_uploaded is not None:
+                on_uploaded(file_object, None)
+            return entry['pid']
+        limiter.wait()
+        start = time.monotonic()
+        pid = create_upload_object_metadata(client, file_object, rights_holder, gc,
+                                            journal)
+        if on_uploaded is not None:
+            on_uploaded(file_object, time.monotonic() - start)
+        return pid
+
+    if not files:
+        return list()
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(files)))) as executor:
+        # map() yields results in submission order, keeping the resource map stable
+        return list(executor.map(upload, files))
+
+
+def _open_environment_tarball(download_url):
+    """
+    Opens the cached copy of an environment tarball. Another process may prune
+    it from the cache before it's opened, in which case it's downloaded again.
+    Once open, pruning the tarball doesn't affect the upload.
+
+    :return: The open tarball, its md5 hex digest and its size
+    :rtype: tuple
+    """
+    for _ in range(3):
+        tarball_path, md5, size = get_environment_tarball(download_url)
+        try:
+            return open(tarball_path, 'rb'), md5, size
+        except FileNotFoundError:
+            logging.info('{} was pruned from the cache, downloading it again'.format(
+                tarball_path))
+    raise IOError('The environment tarball was pruned before it could be uploaded')
+
+
+def create_upload_repository(tale, client, rights_holder, gc, journal=None,
+                             dedup_node=None):
     """
     Downloads the repository that's pointed to by the recipe and uploads it to the
     node that `client` points to.
@@ -434,50 +769,62 @@ def create_upload_repository(tale, client, rights_holder, gc):
     :param client: The interface to the member node
     :param rights_holder: The owner of this object
     :param gc: The girder client
+    :param journal: The journal of the publish job, used to skip the upload if
+     an earlier attempt already created the tarball
+    :param dedup_node: The url of the member node; if set, an identical tarball
+     that was published before is referenced instead of uploading a copy
     :type tale: girder.models.tale
     :type client: MemberNodeClient_2_0
     :type rights_holder: str
+    :type journal: PublishJournal
+    :type dedup_node: str
     :return:
     """
     try:
         image = gc.get('/image/{}'.format(tale['imageId']))
         recipe = gc.get('/recipe/{}'.format(image['recipeId']))
         download_url = recipe['url'] + '/tarball/' + recipe['commitId']
+        if journal is not None:
+            entry = journal.lookup('repository:' + download_url)
+            if entry is not None:
+                return entry['pid'], entry['size']
 
-        with tempfile.NamedTemporaryFile() as temp_file:
-            src = urlopen(download_url)
-            try:
-                # Copy the response into the temporary file
-                copyfileobj(src, temp_file)
-                logging.debug('Copied file, size: {}'.format(temp_file.tell()))
-
-            except IOError as e:
-                error_msg = 'Error copying environment file to disk. {}'.format(e)
-                logging.warning(error_msg)
-
-                # We should stop if we can't upload the repository
-                return error_msg
-        # Create a pid for the file
+        """
+        The tarball is hashed while it's downloaded to the node's tarball cache,
+        and uploaded from there without being read into memory.
+        """
+        tarball, md5, size = _open_environment_tarball(download_url)
+        with tarball:
+            logging.debug('Fetched environment tarball, size: {}'.format(size))
+            if dedup_node is not None:
+                pid = find_published_artifact(client, dedup_node,
+                                              ExtraFileNames.environment_file, md5)
+                if pid is not None:
+                    return pid, size
+
+            # Create a pid for the file
             pid = str(uuid.uuid4())
-        # Create system metadata for the file
-            temp_file.seek(0)
-            meta = generate_system_metadata(pid=pid,
-                                            format_id='application/tar+gzip',
-                                            file_object=temp_file.read(),
-                                            name=ExtraFileNames.environment_file,
-                                            rights_holder=rights_holder)
-            temp_file.seek(0)
+            # Create system metadata for the file
+            meta = populate_sys_meta(pid,
+                                     'application/tar+gzip',
+                                     size,
+                                     md5,
+                                     ExtraFileNames.environment_file,
+                                     rights_holder)
             logging.debug('Uploading repository to DataONE')
-            upload_file(client=client,
-                        pid=pid,
-                        file_object=io.BytesIO(temp_file.read()),
-                        system_metadata=meta)
-
-            size = os.path.getsize(temp_file.name)
+            error = upload_file(client=client,
+                                pid=pid,
+                                file_object=tarball,
+                                system_metadata=meta)
+
+        if journal is not None and error is None:
+            journal.record('repository:' + download_url, pid, size, md5)
+        if dedup_node is not None and error is None:
+            record_published_artifact(dedup_node, ExtraFileNames.environment_file, md5, pid)
         return pid, size
 
-    except IOError as e:
-        logging.debug('Failed to process repository'.format(e))
+    except (IOError, requests.exceptions.RequestException) as e:
+        logging.warning('Failed to process repository. {}'.format(e))
     return None, 0
 
 
@@ -488,7 +835,8 @@ def publish_tale(item_ids,
                  girder_token,
                  userId,
                  prov_info,
-                 license_id):
+                 license_id,
+                 progress=None):
     """
     Handles publishing a tale to DataONE.
 
@@ -511,6 +859,8 @@ def publish_tale(item_ids,
     :param userId: The user's ID
     :param prov_info: Additional information included in the tale yaml
     :param license_id: The spdx of the license used
+    :param progress: Reports the progress of the job and records the duration
+     of each stage of the publish
     :type item_ids: list
     :type taleId: str
     :type dataone_node: str
@@ -519,12 +869,17 @@ def publish_tale(item_ids,
     :type userId: str
     :type prov_info: dict
     :type license_id: str
+    :type progress: JobProgress
     :return: The pid of the package's resource map
     :rtype: str
     """
     client = None
+    if progress is None:
+        progress = JobProgress()
+    # One step for each stage below, plus one per local file once they're known
+    progress.total = 6
     try:
-        gc = girder_client.GirderClient(apiUrl=GIRDER_API_URL)
+        gc = girder_client.GirderClient(apiUrl=get_girder_api_url())
         gc.token = str(girder_token)
     except Exception as e:
         raise ValueError('Error authenticating with Girder {}'.format(e))
@@ -541,27 +896,40 @@ def publish_tale(item_ids,
         logging.debug('Creating the DataONE client')
         client = create_dataone_client(dataone_node, {
             "headers": {
-                "Authorization": "Bearer " + dataone_auth_token,
-                "Connection": "close"},
+                "Authorization": "Bearer " + dataone_auth_token},
             "user_agent": "safari"})
     except DataONEException as e:
         logging.warning('Error creating the DataONE Client: {}'.format(e))
         # We'll want to exit if we can't create the client
         raise ValueError('Failed to establish connection with DataONE. {}'.format(e))
 
+    initial_stats = get_connection_stats(client)
+
     user_id = extract_user_id(dataone_auth_token)
     if user_id is None:
         # Exit if we can't get the userId from the auth_token
         return 'Failed to process your DataONE credentials. Please' \
                ' ensure you are logged into DataONE.'
 
+    """
+    Objects created by an earlier, failed attempt at this publish are listed in
+    the journal and won't be uploaded again.
+    """
+    journal = PublishJournal(taleId, dataone_node, user_id, license_id,
+                             remote=GirderJournalStore(gc, userId))
+
     """
     Sort all of the input files based on where they are located,
         1. HTTP resource
         2. DataONE resource
         3. Local filesystem object
     """
-    filtered_items = filter_items(item_ids, gc)
+    with progress.stage('filter', 'Gathering information about the files') as record:
+        metadata = prefetch_item_metadata(item_ids, gc)
+        filtered_items = filter_items(item_ids, gc, metadata)
+        for location in ('local_files', 'remote', 'dataone'):
+            record[location] = len(filtered_items[location])
+    progress.total += len(filtered_items['local_files'])
 
     """
     Iterate through the list of objects that are local (ie files without a `linkUrl`
@@ -569,32 +937,64 @@ def publish_tale(item_ids,
      return a pid that describes the object (not the metadata object). We'll save
         this pid so that we can pass it to the resource map.
     """
-    local_file_pids = list()
-    for file in filtered_items['local_files']:
-        logging.debug('Processing local files for DataONE upload')
-        local_file_pids.append(create_upload_object_metadata(client, file, user_id, gc))
+    with progress.stage('local_files', 'Uploading files to DataONE', steps=True) as record:
+        record['files'] = list()
+        # Files uploaded by an earlier attempt, which would skew the transfer rates
+        record['skipped'] = 0
+        skipped_lock = threading.Lock()
+
+        def on_uploaded(file_object, seconds):
+            if seconds is None:
+                with skipped_lock:
+                    record['skipped'] += 1
+                progress.update('Already uploaded {}'.format(file_object['name']))
+                return
+            record['files'].append({
+                'name': file_object['name'],
+                'bytes': file_object['size'],
+                'seconds': round(seconds, 3),
+                'bytes_per_second': round(file_object['size'] / seconds) if seconds else None})
+            progress.update('Uploaded {}'.format(file_object['name']))
+
+        local_file_pids = upload_local_files(client,
+                                             filtered_items['local_files'],
+                                             user_id,
+                                             gc,
+                                             dataone_node,
+                                             journal=journal,
+                                             on_uploaded=on_uploaded)
+        record['bytes'] = sum(file['bytes'] for file in record['files'])
 
-    logging.debug('Processing Tale YAML file')
     remote_items = filtered_items['remote'] + filtered_items['dataone']
 
-    tale_yaml_pid, tale_yaml_length = create_upload_tale_yaml(tale,
-                                                              remote_items,
-                                                              item_ids,
-                                                              user,
-                                                              client,
-                                                              prov_info,
-                                                              user_id,
-                                                              gc)
+    with progress.stage('tale_yaml', 'Uploading the Tale configuration') as record:
+        tale_yaml_pid, tale_yaml_length = create_upload_tale_yaml(tale,
+                                                                  remote_items,
+                                                                  item_ids,
+                                                                  user,
+                                                                  client,
+                                                                  prov_info,
+                                                                  user_id,
+                                                                  gc,
+                                                                  metadata,
+                                                                  journal)
+        record['bytes'] = tale_yaml_length
 
     """
     Upload the license file
     """
-    logging.debug('Uploading the license file')
-    license_pid, license_size = upload_license_file(client, license_id, user_id)
+    with progress.stage('license', 'Uploading the license file') as record:
+        dedup_node = dataone_node if DEDUP_ARTIFACTS else None
+        license_pid, license_size = upload_license_file(client, license_id, user_id, journal,
+                                                        dedup_node)
+        record['bytes'] = license_size
 
     """
     Upload the repository"""
-    repository_pid, repository_size = create_upload_repository(tale, client, user_id, gc)
+    with progress.stage('repository', 'Uploading the Tale environment') as record:
+        repository_pid, repository_size = create_upload_repository(tale, client, user_id, gc,
+                                                                   journal, dedup_node)
+        record['bytes'] = repository_size
 
     """
     
@@ -614,17 +1014,19 @@ def publish_tale(item_ids,
 
     eml_items = filter(None, eml_items)
     eml_items = list(eml_items)
-    logging.debug('Creating DataONE EML record for new Tale')
-    eml_pid = create_upload_eml(tale,
-                                client,
-                                user,
-                                eml_items,
-                                license_id,
-                                extract_user_id(dataone_auth_token),
-                                file_sizes,
-                                gc)
-    # Check eml file status. If it failed, we need to exit and let the user know
-    logging.debug('Finished creating DataONE EML record')
+    with progress.stage('eml', 'Creating the DataONE metadata record'):
+        eml_pid = create_upload_eml(tale,
+                                    client,
+                                    user,
+                                    eml_items,
+                                    license_id,
+                                    extract_user_id(dataone_auth_token),
+                                    file_sizes,
+                                    gc,
+                                    metadata,
+                                    journal)
+    # create_upload_eml raises if the record can't be created, so the job fails with
+    # the reason before a resource map referencing no EML is uploaded
 
     """
     Once all objects are uploaded, create and upload the resource map. This file describes
@@ -634,13 +1036,22 @@ def publish_tale(item_ids,
     """
     upload_objects = list(local_file_pids + [tale_yaml_pid, license_pid, repository_pid])
     resmap_pid = str(uuid.uuid4())
-    logging.debug('Creating DataONE resource map')
-    create_upload_resmap(resmap_pid,
-                         eml_pid,
-                         upload_objects,
-                         client,
-                         user_id)
-    logging.debug('Finished creating DataONE resource map')
+    with progress.stage('resource_map', 'Creating the DataONE resource map'):
+        error = create_upload_resmap(resmap_pid,
+                                     eml_pid,
+                                     upload_objects,
+                                     client,
+                                     user_id)
+    if error is None:
+        # The package is complete, a new publish must not reuse these objects
+        journal.clear()
+    num_requests, num_connections = [
+        end - start for start, end in zip(initial_stats, get_connection_stats(client))]
+    logging.info('Sent {} requests to {} over {} new connections ({} handshakes saved)'.format(
+        num_requests, dataone_node, num_connections,
+        max(0, num_requests - num_connections)))
+    progress.info['dataone_connections'] = {'requests': num_requests,
+                                            'new_connections': num_connections}
     package_url = get_dataone_package_url(dataone_node, resmap_pid)
 
     return package_url
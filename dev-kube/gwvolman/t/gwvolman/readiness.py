@@ -0,0 +1,151 @@
+"""Waiting for Tale servers to answer on their public url.
+
+Probes run on a single asyncio event loop per worker process, in a background
+thread. A single launch still blocks its worker thread until its server is up;
+wait_until_all_ready lets a batch launch wait on many servers from one thread.
+"""
+import asyncio
+import logging
+import os
+import random
+import ssl
+import threading
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+# Seconds after which a server that doesn't answer is considered failed
+READINESS_TIMEOUT = float(os.environ.get('READINESS_TIMEOUT', 300))
+# Delay before the second probe, doubled after each failed probe up to the max
+READINESS_INITIAL_DELAY = float(os.environ.get('READINESS_INITIAL_DELAY', 0.25))
+READINESS_MAX_DELAY = float(os.environ.get('READINESS_MAX_DELAY', 8))
+# Connect and read timeout of a single probe
+READINESS_PROBE_TIMEOUT = float(os.environ.get('READINESS_PROBE_TIMEOUT', 5))
+READINESS_VERIFY_TLS = os.environ.get('READINESS_VERIFY_TLS', 'true').lower() in \
+    ('1', 'true', 'yes')
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop():
+    """Returns the process' event loop, started on first use (and after a fork)."""
+    global _loop, _loop_pid
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            threading.Thread(target=_loop.run_forever, name='readiness',
+                             daemon=True).start()
+        return _loop
+
+
+def _ssl_context():
+    context = ssl.create_default_context()
+    if not READINESS_VERIFY_TLS:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def is_ready(status):
+    """
+    Any answer from the server itself means it's up. Gateway errors, and the
+    404 returned by the proxy until the route exists, mean it isn't.
+    """
+    return status is not None and (200 <= status < 400 or status in (401, 403))
+
+
+async def probe(url, timeout=READINESS_PROBE_TIMEOUT):
+    """
+    Sends a GET request to the url.
+
+    :return: The status code of the response, or None if there was none
+    :rtype: int
+    """
+    parsed = urlparse(url)
+    https = parsed.scheme == 'https'
+    path = parsed.path or '/'
+    if parsed.query:
+        path += '?' + parsed.query
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            parsed.hostname, parsed.port or (443 if https else 80),
+            ssl=_ssl_context() if https else None), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    try:
+        writer.write('GET {} HTTP/1.1\r\nHost: {}\r\nConnection: close\r\n\r\n'.format(
+            path, parsed.netloc).encode('latin-1'))
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    finally:
+        writer.close()
+    try:
+        return int(status_line.split()[1])
+    except (IndexError, ValueError):
+        return None
+
+
+async def wait_for_server(url, timeout=READINESS_TIMEOUT):
+    """
+    Probes the url with exponential backoff and jitter until the server is up.
+
+    :return: The time to ready in seconds
+    :rtype: float
+    :raises TimeoutError: If the server isn't up after `timeout` seconds
+    """
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    deadline = start + timeout
+    delay = READINESS_INITIAL_DELAY
+    status = None
+    while True:
+        status = await probe(url)
+        if is_ready(status):
+            return loop.time() - start
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            raise TimeoutError('{} was not ready after {}s (last status: {})'.format(
+                url, timeout, status))
+        # Half of the delay is random so that launches don't probe in lockstep
+        await asyncio.sleep(min(remaining, delay / 2 + random.uniform(0, delay / 2)))
+        delay = min(delay * 2, READINESS_MAX_DELAY)
+
+
+def wait_until_ready(url, timeout=READINESS_TIMEOUT):
+    """
+    Blocks until the server answers on `url`.
+
+    :param url: The public url of the instance, including its rendered path
+    :param timeout: The max number of seconds to wait
+    :type url: str
+    :type timeout: float
+    :return: The time to ready in seconds
+    :rtype: float
+    :raises TimeoutError: If the server isn't up in time
+    """
+    future = asyncio.run_coroutine_threadsafe(wait_for_server(url, timeout), _get_loop())
+    seconds = future.result()
+    logging.info('time_to_ready={:.3f} url={}'.format(seconds, url))
+    return seconds
+
+
+def wait_until_all_ready(urls, timeout=READINESS_TIMEOUT):
+    """
+    Waits for several servers at once.
+
+    :return: The time to ready of each url, or the exception it failed with
+    :rtype: list
+    """
+    async def wait_all():
+        return await asyncio.gather(*[wait_for_server(url, timeout) for url in urls],
+                                    return_exceptions=True)
+    results = asyncio.run_coroutine_threadsafe(wait_all(), _get_loop()).result()
+    for url, result in zip(urls, results):
+        if not isinstance(result, Exception):
+            logging.info('time_to_ready={:.3f} url={}'.format(result, url))
+    return results
@@ -1,85 +1,109 @@
 """A set of WT related Girder tasks."""
 import os
-import shutil
-import socket
-import json
-import time
-import tempfile
-import textwrap
-import docker
-import subprocess
-from docker.errors import DockerException
-import girder_client
 from .tasks_factory import TasksFactory
 
-import logging
-try:
-    from urlparse import urlparse
-except ImportError:
-    from urllib.parse import urlparse
 from girder_worker.utils import girder_job
 from girder_worker.app import app
-# from girder_worker.plugins.docker.executor import _pull_image
-from .utils import \
-    HOSTDIR, REGISTRY_USER, REGISTRY_PASS, \
-    new_user, _safe_mkdir, _get_api_key, \
-    _get_container_config, _launch_container, _get_user_and_instance, \
-    DEPLOYMENT
-from .publish import publish_tale
-from .constants import GIRDER_API_URL, InstanceStatus, ENABLE_WORKSPACES, \
-    DEFAULT_USER, DEFAULT_GROUP, MOUNTPOINTS
 
 flavor = 'docker'
 if 'TASKS_FLAVOR' in os.environ:
     flavor = os.environ['TASKS_FLAVOR']
 
-tasksCls = TasksFactory().getTasks(flavor)
+_tasksCls = None
+
+
+def getTasksCls():
+    """
+    Returns the implementation of the tasks for the configured flavor. It's
+    imported when the first task runs, which keeps importing this module (and
+    so starting a worker) free of docker, DataONE and network access.
+    """
+    global _tasksCls
+    if _tasksCls is None:
+        _tasksCls = TasksFactory().getTasks(flavor)
+    return _tasksCls
 
 
 @girder_job(title='Create Tale Data Volume')
 @app.task(bind=True)
 def create_volume(self, instanceId: str):
     """Create a mountpoint and compose WT-fs."""
-    return tasksCls.create_volume(self, instanceId)
+    return getTasksCls().create_volume(self, instanceId)
 
 
 @girder_job(title='Spawn Instance')
 @app.task(bind=True)
 def launch_container(self, payload):
     """Launch a container using a Tale object."""
-    return tasksCls.launch_container(self, payload)
+    return getTasksCls().launch_container(self, payload)
+
+
+@girder_job(title='Spawn Instances')
+@app.task(bind=True)
+def launch_containers(self, payloads):
+    """Launch many instances in a single job.
+
+    Takes the result of create_volume for each instance, and returns the
+    launched payload or the error of each instance.
+    """
+    return getTasksCls().launch_containers(self, payloads)
 
 
 @girder_job(title='Update Instance')
 @app.task(bind=True)
 def update_container(self, instanceId, **kwargs):
-    return tasksCls.update_container(self, instanceId, kwarks)
+    return getTasksCls().update_container(self, instanceId, **kwargs)
 
 
 @girder_job(title='Shutdown Instance')
 @app.task(bind=True)
 def shutdown_container(self, instanceId):
     """Shutdown a running Tale."""
-    return tasksCls.shutdown_container(self, instanceId)
+    return getTasksCls().shutdown_container(self, instanceId)
 
 
 @girder_job(title='Remove Tale Data Volume')
 @app.task(bind=True)
 def remove_volume(self, instanceId):
     """Unmount WT-fs and remove mountpoint."""
-    return tasksCls.remove_volume(self, instanceId)
+    return getTasksCls().remove_volume(self, instanceId)
 
 
 @girder_job(title='Build WT Image')
 @app.task
 def build_image(image_id, repo_url, commit_id):
     """Build docker image from WT Image object and push to a registry."""
-    return tasksCls.build_image(image_id, repo_url, commit_id)
+    result = getTasksCls().build_image(image_id, repo_url, commit_id)
+    # The image is in the registry, have the nodes pull it now rather than on
+    # its first launch
+    prepull_image.delay(image_id)
+    return result
+
+
+@app.task
+def prepull_image(image_id):
+    """Pull an image on the nodes ahead of the instances that use it."""
+    return getTasksCls().prepull_image(image_id)
 
 
-@girder_job(title='Publish Tale')
 @app.task
-def publish(item_ids,
+def refill_pool():
+    """Evict stale containers from the node's warm pool and top it up."""
+    from . import pool
+    return pool.refill_pool()
+
+
+@app.task
+def cull_idle_instances():
+    """Shut down the instances that have been idle for too long."""
+    from . import culler
+    return culler.cull_idle_instances()
+
+
+@girder_job(title='Publish Tale')
+@app.task(bind=True)
+def publish(self,
+            item_ids,
             tale,
             dataone_node,
             dataone_auth_token,
@@ -106,9 +130,11 @@ def publish(item_ids,
     :type userId: str
     :type prov_info: dict
     :type license_id: str
+    :return: The url of the package
+    :rtype: str
     """
-    return tasksCls.publish_tale(item_ids, tale, dataone_node, 
-                                 dataone_auth_token, girder_token, userId, 
+    return getTasksCls().publish(self, item_ids, tale, dataone_node,
+                                 dataone_auth_token, girder_token, userId,
                                  prov_info, license_id)
 
 
@@ -120,4 +146,16 @@ def import_tale(self, lookup_kwargs, tale_kwargs, spawn=True):
     Currently, this task only handles importing raw data. In the future, it
     should also allow importing serialized Tales.
     """
-    return tasksCls.import_tale(self, lookup_kwarks, tale_kwargs, spawn)
+    return getTasksCls().import_tale(self, lookup_kwargs, tale_kwargs, spawn)
+
+
+@girder_job(title='Import Tales')
+@app.task(bind=True)
+def import_tales(self, dataIds, lookup_kwargs, tale_kwargs, spawn=False):
+    """Create a Tale for each of many external datasets in a single job.
+
+    Returns the Tale, instance or error of each dataId, so that a dataset that
+    can't be imported doesn't fail the others.
+    """
+    return getTasksCls().import_tales(self, dataIds, lookup_kwargs, tale_kwargs,
+                                      spawn)
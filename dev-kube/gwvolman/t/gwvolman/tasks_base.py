@@ -8,6 +8,7 @@ import tempfile
 import textwrap
 import subprocess
 import girder_client
+from concurrent.futures import ThreadPoolExecutor
 
 import logging
 try:
@@ -17,10 +18,161 @@ except ImportError:
 from girder_worker.utils import girder_job
 from girder_worker.app import app
 # from girder_worker.plugins.docker.executor import _pull_image
-from .publish import publish_tale
-from .constants import GIRDER_API_URL, InstanceStatus, ENABLE_WORKSPACES, \
+from .progress import JobProgress
+from .utils import poll_until
+from .constants import InstanceStatus, ENABLE_WORKSPACES, \
     DEFAULT_USER, DEFAULT_GROUP, MOUNTPOINTS
 
+# Seconds that import_tale waits for the new Tale's instance to be running
+IMPORT_INSTANCE_TIMEOUT = float(os.environ.get('IMPORT_INSTANCE_TIMEOUT', 900))
+# Number of dataIds sent in each /repository/lookup request of a batch import
+IMPORT_LOOKUP_BATCH = int(os.environ.get('IMPORT_LOOKUP_BATCH', 50))
+# Number of Tales created concurrently by a batch import
+IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', 4))
+CATALOG_PATH = '/collection/WholeTale Catalog/WholeTale Catalog'
+
+
+def _girder_error(resp):
+    """Returns the message of a Girder error response."""
+    try:
+        return json.loads(resp.responseText).get('message', '')
+    except json.JSONDecodeError:
+        return str(resp)
+
+
+def _tale_payload(user, resource, tale_kwargs):
+    """Returns the Tale for a registered dataset, with `tale_kwargs` on top."""
+    # Try to come up with a good name for the dataset
+    long_name = resource['name']
+    long_name = long_name.replace('-', ' ').replace('_', ' ')
+    shortened_name = textwrap.shorten(text=long_name, width=30)
+
+    payload = {
+        'authors': user['firstName'] + ' ' + user['lastName'],
+        'title': 'A Tale for \"{}\"'.format(shortened_name),
+        'dataSet': [
+            {
+                'mountPath': '/' + resource['name'],
+                'itemId': resource['_id'],
+                '_modelType': resource['_modelType']
+            }
+        ],
+        'public': False,
+        'published': False
+    }
+
+    # allow to override title, etc. MUST contain imageId
+    payload.update(tale_kwargs)
+    return payload
+
+
+def _spawn_instance(gc, tale):
+    """Launches an instance of the Tale and waits until it's running."""
+    try:
+        instance = gc.post('/instance', parameters={'taleId': tale['_id']})
+    except girder_client.HttpError as resp:
+        errormsg = 'Unable to create instance. Server returned {}: {}'
+        errormsg = errormsg.format(resp.status, _girder_error(resp))
+        raise ValueError(errormsg)
+
+    try:
+        instance = poll_until(
+            lambda: gc.get('/instance/{_id}'.format(**instance)),
+            lambda current: current['status'] != InstanceStatus.LAUNCHING,
+            IMPORT_INSTANCE_TIMEOUT)
+    except TimeoutError:
+        errormsg = 'Instance was not running after {}s. Aborting!'
+        raise ValueError(errormsg.format(IMPORT_INSTANCE_TIMEOUT))
+    if instance['status'] == InstanceStatus.ERROR:
+        raise ValueError('Failed to launch the instance. Aborting!')
+    return instance
+
+
+def _lookup_datasets(gc, dataIds, lookup_kwargs):
+    """
+    Looks up many dataIds with one /repository/lookup request per batch. The
+    entries of a batch are matched to the dataIds by their `dataId`, and the
+    dataIds that didn't get one, e.g. because the batch failed, are looked up
+    one by one so that one bad dataId doesn't fail the others.
+
+    :return: The dataMap entry, or an error message, for each dataId
+    :rtype: list
+    """
+    def lookup(batch):
+        parameters = dict(dataId=json.dumps(batch))
+        parameters.update(lookup_kwargs)
+        return gc.get('/repository/lookup', parameters=parameters)
+
+    entries = []
+    for start in range(0, len(dataIds), IMPORT_LOOKUP_BATCH):
+        batch = dataIds[start:start + IMPORT_LOOKUP_BATCH]
+        try:
+            found = {entry.get('dataId'): entry for entry in lookup(batch)}
+        except Exception as e:
+            logging.info('Looking up the datasets one by one after: {}'.format(e))
+            found = {}
+        for dataId in batch:
+            if dataId in found:
+                entries.append(found[dataId])
+                continue
+            try:
+                dataMap = lookup([dataId])
+            except girder_client.HttpError as resp:
+                errormsg = 'Unable to register \"{}\". Server returned {}: {}'
+                entries.append(errormsg.format(dataId, resp.status, _girder_error(resp)))
+                continue
+            except Exception as e:
+                entries.append('Unable to register \"{}\". {}'.format(dataId, e))
+                continue
+            if dataMap:
+                entries.append(dataMap[0])
+            else:
+                errormsg = 'Unable to register \"{}\". Source is not supported'
+                entries.append(errormsg.format(dataId))
+    return entries
+
+
+def _register_datasets(gc, dataMap):
+    """
+    Registers the datasets with one /dataset/register request, or one by one
+    if it fails.
+
+    :return: An error message for each dataset that failed to register
+    :rtype: dict
+    """
+    try:
+        gc.post('/dataset/register', parameters={'dataMap': json.dumps(dataMap)})
+        return {}
+    except Exception as e:
+        logging.info('Registering the datasets one by one after: {}'.format(e))
+    errors = {}
+    for entry in dataMap:
+        try:
+            gc.post('/dataset/register', parameters={'dataMap': json.dumps([entry])})
+        except girder_client.HttpError as resp:
+            errormsg = 'Unable to register \"{}\". Server returned {}: {}'
+            errors[entry['name']] = errormsg.format(entry['name'], resp.status,
+                                                    _girder_error(resp))
+        except Exception as e:
+            errors[entry['name']] = 'Unable to register \"{}\". {}'.format(entry['name'], e)
+    return errors
+
+
+def _list_catalog(gc):
+    """
+    Lists the folders and items of the catalog by name. Like import_tale, a
+    folder takes precedence over an item with the same name.
+
+    :rtype: dict
+    """
+    catalog = gc.get('/resource/lookup', parameters={'path': CATALOG_PATH})
+    resources = {}
+    for item in gc.listItem(catalog['_id']):
+        resources.setdefault(item['name'], item)
+    for folder in gc.listFolder(catalog['_id'], parentFolderType='folder'):
+        resources[folder['name']] = folder
+    return resources
+
 
 class TasksBase:
     def __init__(self):
@@ -32,6 +184,9 @@ class TasksBase:
     def launch_container(self, payload):
         raise NotImplementedError()
 
+    def launch_containers(self, payloads):
+        raise NotImplementedError()
+
     def update_container(self, instanceId, **kwargs):
         raise NotImplementedError()
 
@@ -44,11 +199,33 @@ class TasksBase:
     def build_image(image_id, repo_url, commit_id):
         raise NotImplementedError()
 
-    def publish(item_ids, tale, dataone_node, dataone_auth_token,
+    def prepull_image(image_id):
+        """Pull an image on the worker's node with its docker daemon."""
+        from .docker_client import DOCKER_CLIENT
+        from .inventory import pull_image, LOCAL_DOCKER_INVENTORY
+        from .utils import DEPLOYMENT
+        image = urlparse(DEPLOYMENT.registry_url).netloc + '/' + image_id
+        if DOCKER_CLIENT.call(pull_image, image):
+            LOCAL_DOCKER_INVENTORY.refresh()
+
+    def publish(self, item_ids, tale, dataone_node, dataone_auth_token,
                 girder_token, userId, prov_info, license_id):
-        return publish_tale(item_ids, tale, dataone_node,
-                            dataone_auth_token, girder_token,
-                            userId, prov_info, license_id)
+        """Publish a Tale to DataONE.
+
+        Returns the url of the package. The summary of the time spent in each
+        stage of the publish is written to the job's log.
+        """
+        # DataONE's client libraries are only loaded by workers that publish
+        from .publish import publish_tale
+
+        progress = JobProgress(self.job_manager)
+        package_url = publish_tale(item_ids, tale, dataone_node,
+                                   dataone_auth_token, girder_token,
+                                   userId, prov_info, license_id, progress)
+        summary = 'Publish summary: {}'.format(json.dumps(progress.summary()))
+        logging.info(summary)
+        self.job_manager.write(summary + '\n')
+        return package_url
 
     def import_tale(self, lookup_kwargs, tale_kwargs, spawn=True):
         """Create a Tale provided a url for an external data and an image Id.
@@ -71,12 +248,8 @@ class TasksBase:
             dataMap = self.girder_client.get(
                 '/repository/lookup', parameters=parameters)
         except girder_client.HttpError as resp:
-            try:
-                message = json.loads(resp.responseText).get('message', '')
-            except json.JSONDecodeError:
-                message = str(resp)
             errormsg = 'Unable to register \"{}\". Server returned {}: {}'
-            errormsg = errormsg.format(dataId[0], resp.status, message)
+            errormsg = errormsg.format(dataId[0], resp.status, _girder_error(resp))
             raise ValueError(errormsg)
 
         if not dataMap:
@@ -91,9 +264,8 @@ class TasksBase:
             '/dataset/register', parameters={'dataMap': json.dumps(dataMap)})
 
         # Get resulting folder/item by name
-        catalog_path = '/collection/WholeTale Catalog/WholeTale Catalog'
         catalog = self.girder_client.get(
-            '/resource/lookup', parameters={'path': catalog_path})
+            '/resource/lookup', parameters={'path': CATALOG_PATH})
         folders = self.girder_client.get(
             '/folder', parameters={'name': dataMap[0]['name'],
                                'parentId': catalog['_id'],
@@ -111,50 +283,14 @@ class TasksBase:
                 errormsg = 'Registration failed. Aborting!'
                 raise ValueError(errormsg)
 
-        # Try to come up with a good name for the dataset
-        long_name = resource['name']
-        long_name = long_name.replace('-', ' ').replace('_', ' ')
-        shortened_name = textwrap.shorten(text=long_name, width=30)
-
         user = self.girder_client.get('/user/me')
-        payload = {
-            'authors': user['firstName'] + ' ' + user['lastName'],
-            'title': 'A Tale for \"{}\"'.format(shortened_name),
-            'dataSet': [
-                {
-                    'mountPath': '/' + resource['name'],
-                    'itemId': resource['_id'],
-                    '_modelType': resource['_modelType']
-                }
-            ],
-            'public': False,
-            'published': False
-        }
-
-        # allow to override title, etc. MUST contain imageId
-        payload.update(tale_kwargs)
+        payload = _tale_payload(user, resource, tale_kwargs)
         tale = self.girder_client.post('/tale', json=payload)
 
         if spawn:
             self.job_manager.updateProgress(
                 message='Creating a Tale container', total=total, current=3)
-            try:
-                instance = self.girder_client.post(
-                    '/instance', parameters={'taleId': tale['_id']})
-            except girder_client.HttpError as resp:
-                try:
-                    message = json.loads(resp.responseText).get('message', '')
-                except json.JSONDecodeError:
-                    message = str(resp)
-                errormsg = 'Unable to create instance. Server returned {}: {}'
-                errormsg = errormsg.format(resp.status, message)
-                raise ValueError(errormsg)
-
-            while instance['status'] == InstanceStatus.LAUNCHING:
-                # TODO: Timeout? Raise error?
-                time.sleep(1)
-                instance = self.girder_client.get(
-                    '/instance/{_id}'.format(**instance))
+            instance = _spawn_instance(self.girder_client, tale)
         else:
             instance = None
 
@@ -162,3 +298,59 @@ class TasksBase:
             message='Tale is ready!', total=total, current=total)
         # TODO: maybe filter results?
         return {'tale': tale, 'instance': instance}
+
+    def import_tales(self, dataIds, lookup_kwargs, tale_kwargs, spawn=False):
+        """Create a Tale for each of many external datasets.
+
+        The datasets are looked up and registered with bulk requests, and the
+        resulting folders and items are found in a single listing of the
+        catalog. The Tales are then created concurrently. A dataset that fails
+        doesn't fail the others: the result has the Tale, or the error, of
+        each dataId.
+        """
+        gc = self.girder_client
+        progress = JobProgress(self.job_manager, total=3 + len(dataIds))
+        results = [{'dataId': dataId, 'tale': None, 'instance': None, 'error': None}
+                   for dataId in dataIds]
+
+        with progress.stage('lookup', 'Gathering basic info about the datasets'):
+            entries = _lookup_datasets(gc, dataIds, lookup_kwargs)
+        for result, entry in zip(results, entries):
+            if not isinstance(entry, dict):
+                result['error'] = entry
+
+        with progress.stage('register', 'Registering the datasets in Whole Tale'):
+            dataMap = [entry for entry in entries if isinstance(entry, dict)]
+            errors = _register_datasets(gc, dataMap) if dataMap else {}
+        with progress.stage('catalog', 'Listing the registered datasets'):
+            resources = _list_catalog(gc)
+        user = gc.get('/user/me')
+
+        def create_tale(result, entry):
+            if result['error'] is None:
+                try:
+                    if entry['name'] in errors:
+                        raise ValueError(errors[entry['name']])
+                    try:
+                        resource = resources[entry['name']]
+                    except KeyError:
+                        raise ValueError('Registration failed. Aborting!')
+                    result['tale'] = gc.post(
+                        '/tale', json=_tale_payload(user, resource, tale_kwargs))
+                    if spawn:
+                        result['instance'] = _spawn_instance(gc, result['tale'])
+                except Exception as e:
+                    # Whatever goes wrong only fails this dataset
+                    result['error'] = str(e) or repr(e)
+            if result['error'] is not None:
+                logging.warning('Failed to import {}: {}'.format(result['dataId'],
+                                                                 result['error']))
+            progress.update('Imported {}'.format(result['dataId']))
+
+        with progress.stage('tales', 'Creating the Tales', steps=True):
+            with ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as executor:
+                list(executor.map(create_tale, results, entries))
+
+        failed = sum(1 for result in results if result['error'] is not None)
+        progress.info.update({'imported': len(results) - failed, 'failed': failed})
+        return {'results': results, 'summary': progress.summary()}
@@ -26,7 +26,7 @@ from .utils import \
     _get_container_config, _launch_container, _get_user_and_instance, \
     DEPLOYMENT
 from .publish import publish_tale
-from .constants import GIRDER_API_URL, InstanceStatus, ENABLE_WORKSPACES, \
+from .constants import InstanceStatus, ENABLE_WORKSPACES, \
     DEFAULT_USER, DEFAULT_GROUP, MOUNTPOINTS
 
 flavor = 'docker'
@@ -0,0 +1,198 @@
+"""Tasks for WT deployments on a docker swarm.
+
+Each instance runs as a swarm service routed by traefik to `<host>.<DOMAIN>`.
+The Tale's data, home and workspace are WT-fs mounts in a local docker volume
+of the node that created it, so the instance is constrained to that node.
+"""
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+from .tasks_base import TasksBase
+from .deployment import DEPLOYMENT
+from .docker_client import DOCKER_CLIENT
+from .pool import _node_id
+from .utils import \
+    HOSTDIR, new_user, _safe_mkdir, _get_api_key, _get_user_and_instance, \
+    _get_container_config, _launch_container
+from .constants import ENABLE_WORKSPACES, DEFAULT_USER, DEFAULT_GROUP, \
+    MOUNTPOINTS, get_girder_api_url
+
+
+def _create_local_volume(cli, name):
+    volume = cli.volumes.create(name=name, driver='local')
+    return volume.name, volume.attrs['Mountpoint'], _node_id(cli)
+
+
+def _remove_local_volume(cli, name):
+    import docker
+    try:
+        volume = cli.volumes.get(name)
+    except docker.errors.NotFound:
+        logging.info('Volume not present [{}].'.format(name))
+        return
+    logging.info('Removing volume: {}'.format(volume.id))
+    volume.remove()
+
+
+def _remove_service(cli, name):
+    import docker
+    try:
+        service = cli.services.get(name)
+    except docker.errors.NotFound:
+        # shutdown_container is broadcast, another node may have removed it
+        logging.info('Service not present [{}].'.format(name))
+        return
+    logging.info('Releasing container [{}].'.format(service.name))
+    # The slot of a pooled container is released by the node's next refill
+    service.remove()
+
+
+def _update_service(cli, name, image):
+    cli.services.get(name).update(image=image)
+
+
+def _check_stream(lines):
+    """Raises the first error reported in the output of a build or a push."""
+    import docker
+    for line in lines:
+        if 'error' in line:
+            raise docker.errors.APIError(line['error'])
+        if 'stream' in line:
+            logging.debug(line['stream'].rstrip())
+
+
+def _build_and_push(cli, path, tag):
+    _check_stream(cli.api.build(path=path, pull=True, tag=tag, decode=True))
+    _check_stream(cli.api.push(tag, stream=True, decode=True))
+    return cli.api.inspect_image(tag)['RepoDigests'][0]
+
+
+def _mount_girderfs(fs_type, api_key, dest, resource_id):
+    cmd = ['girderfs', '-c', fs_type, '--api-url', get_girder_api_url(),
+           '--api-key', api_key, dest, resource_id]
+    logging.info('Mounting {} on {}'.format(fs_type, dest))
+    subprocess.check_call(cmd)
+
+
+def _unmount_volume(mountpoint):
+    for path in MOUNTPOINTS:
+        dest = os.path.join(mountpoint, path)
+        logging.info('Unmounting {}'.format(dest))
+        subprocess.call(['umount', dest])
+
+
+def _delete_session(gc, session_id):
+    try:
+        gc.delete('/dm/session/' + session_id)
+    except Exception as e:
+        logging.error('Unable to remove session {}: {}'.format(session_id, e))
+
+
+class DockerTasks(TasksBase):
+
+    def create_volume(self, instanceId: str):
+        """Create a local volume on the worker's node and compose WT-fs in it."""
+        gc = self.girder_client
+        user, instance = _get_user_and_instance(gc, instanceId)
+        tale = gc.get('/tale/' + instance['taleId'])
+        vol_name = '{}_{}_{}'.format(tale['_id'], user['login'], new_user(6))
+
+        # Volumes only need the daemon, not the registry
+        vol_name, mountpoint, node_id = DOCKER_CLIENT.call(
+            _create_local_volume, vol_name, login=False)
+        logging.info('Volume: {} created at {}'.format(vol_name, mountpoint))
+        session = None
+        try:
+            os.chown(HOSTDIR + mountpoint, DEFAULT_USER, DEFAULT_GROUP)
+            for path in MOUNTPOINTS:
+                dest = HOSTDIR + os.path.join(mountpoint, path)
+                _safe_mkdir(dest)
+                os.chown(dest, DEFAULT_USER, DEFAULT_GROUP)
+                # FUSE needs the mount point to also exist inside the worker
+                os.makedirs(os.path.join(mountpoint, path), exist_ok=True)
+
+            api_key = _get_api_key(gc)
+            session = gc.post('/dm/session', parameters={'taleId': tale['_id']})
+            _mount_girderfs('wt_dms', api_key, os.path.join(mountpoint, 'data'),
+                            session['_id'])
+            home = gc.loadOrCreateFolder('Home', user['_id'], 'user')
+            _mount_girderfs('wt_home', api_key, os.path.join(mountpoint, 'home'),
+                            home['_id'])
+            if ENABLE_WORKSPACES:
+                _mount_girderfs('wt_work', api_key, os.path.join(mountpoint, 'workspace'),
+                                tale['_id'])
+        except Exception:
+            # Nothing refers to the volume yet, so nothing else would remove it
+            _unmount_volume(mountpoint)
+            if session is not None:
+                _delete_session(gc, session['_id'])
+            try:
+                DOCKER_CLIENT.call(_remove_local_volume, vol_name, login=False)
+            except Exception:
+                logging.exception('Failed to clean up {}'.format(vol_name))
+            raise
+
+        return dict(
+            nodeId=node_id,
+            mountPoint=mountpoint,
+            volumeName=vol_name,
+            sessionId=session['_id'],
+            instanceId=instanceId,
+        )
+
+    def launch_container(self, payload):
+        """Launch the instance's service, from the node's warm pool if possible."""
+        instance = self.girder_client.get('/instance/' + payload['instanceId'])
+        tale = self.girder_client.get('/tale/' + instance['taleId'])
+        container_config = _get_container_config(self.girder_client, tale)
+        service, attrs = _launch_container(payload['volumeName'], payload['nodeId'],
+                                           container_config)
+        payload.update(attrs)
+        payload['name'] = service.name
+        return payload
+
+    def update_container(self, instanceId, digest=None, **kwargs):
+        """Roll the instance's service onto a new build of its image."""
+        user, instance = _get_user_and_instance(self.girder_client, instanceId)
+        tale = self.girder_client.get('/tale/' + instance['taleId'])
+        container_config = _get_container_config(self.girder_client, tale)
+        image = container_config.image
+        if digest:
+            image = '{}@{}'.format(image, digest)
+        DOCKER_CLIENT.call(_update_service, instance['containerInfo']['name'], image)
+        return {'image_digest': digest}
+
+    def shutdown_container(self, instanceId):
+        """Remove the instance's service."""
+        user, instance = _get_user_and_instance(self.girder_client, instanceId)
+        DOCKER_CLIENT.call(_remove_service, instance['containerInfo']['name'],
+                           login=False)
+
+    def remove_volume(self, instanceId):
+        """Unmount WT-fs and remove the instance's volume."""
+        user, instance = _get_user_and_instance(self.girder_client, instanceId)
+        containerInfo = instance['containerInfo']
+        _unmount_volume(containerInfo['mountPoint'])
+        session_id = containerInfo.get('sessionId', instance.get('sessionId'))
+        if session_id:
+            _delete_session(self.girder_client, session_id)
+        DOCKER_CLIENT.call(_remove_local_volume, containerInfo['volumeName'],
+                           login=False)
+
+    def build_image(image_id, repo_url, commit_id):
+        """Build the image from its repository and push it to the registry."""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            subprocess.check_call(['git', 'clone', '--recursive', repo_url, temp_dir])
+            subprocess.check_call(['git', 'checkout', commit_id], cwd=temp_dir)
+            tag = urlparse(DEPLOYMENT.registry_url).netloc + '/' + image_id
+            return DOCKER_CLIENT.call(_build_and_push, temp_dir, tag)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
@@ -1,13 +1,17 @@
-from .tasks_docker import DockerTasks
-from .tasks_kubernetes import KubernetesTasks
+import importlib
+
 
 class TasksFactory:
     def __init__(self):
+        # Flavors are imported on first use, so that importing the tasks
+        # doesn't pull in the docker or kubernetes clients
         self.dict = {}
-        self.dict['docker'] = DockerTasks
-        self.dict['kubernetes'] = KubernetesTasks
-    
+        self.dict['docker'] = ('.tasks_docker', 'DockerTasks')
+        self.dict['kubernetes'] = ('.tasks_kubernetes', 'KubernetesTasks')
+
     def getTasks(self, flavor):
         if flavor not in self.dict:
             raise Exception('Unsupported tasks flavor: %s', flavor)
-        return self.dict[flavor]
\ No newline at end of file
+        module_name, class_name = self.dict[flavor]
+        module = importlib.import_module(module_name, __package__)
+        return getattr(module, class_name)
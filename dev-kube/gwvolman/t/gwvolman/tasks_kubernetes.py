@@ -0,0 +1,539 @@
+"""Tasks for WT deployments on Kubernetes.
+
+Each instance runs as a Deployment with a single replica, exposed through a
+Service and an Ingress on `<host>.<DOMAIN>`. The Tale's data, home and
+workspace are PersistentVolumes backed by the wt-webdav CSI driver, so the
+scheduler is free to place the instance on any node.
+"""
+import json
+import logging
+import os
+import shlex
+import time
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+from kubernetes import client, config
+from kubernetes.client.rest import ApiException
+
+from .tasks_base import TasksBase
+from .deployment import DEPLOYMENT, get_kubernetes_namespace
+from .inventory import NodeImageInventory, list_kubernetes_node_images
+from .progress import JobProgress
+from .readiness import wait_until_ready, wait_until_all_ready
+from .utils import \
+    DOMAIN, new_user, _get_user_and_instance, _get_container_config, \
+    _get_container_configs, _render_container_command, poll_until
+from .constants import MOUNTPOINTS, get_girder_api_url
+
+CSI_DRIVER = os.environ.get('K8S_CSI_DRIVER', 'csi-webdavplugin')
+# Root of the WebDAV server exposing the Tale's files, the Girder server by default
+WEBDAV_URL = os.environ.get('WEBDAV_URL')
+# WebDAV url of each mount point; the templates are formatted with the root url
+# as `webdav` and with `login`, `taleId` and `instanceId`
+WEBDAV_URL_TEMPLATES = {
+    'data': '{webdav}/tale_data/{taleId}',
+    'home': '{webdav}/homes/{login}',
+    'workspace': '{webdav}/tales/{taleId}',
+}
+WEBDAV_URL_TEMPLATES.update(json.loads(os.environ.get('K8S_WEBDAV_URLS', '{}')))
+# Name of a docker-registry Secret used to pull Tale images
+IMAGE_PULL_SECRET = os.environ.get('K8S_IMAGE_PULL_SECRET')
+# Name of the TLS Secret of the instances' Ingress; plain http if not set
+INGRESS_TLS_SECRET = os.environ.get('K8S_INGRESS_TLS_SECRET')
+INGRESS_CLASS = os.environ.get('K8S_INGRESS_CLASS')
+# Seconds to wait for an instance to become ready
+LAUNCH_TIMEOUT = float(os.environ.get('K8S_LAUNCH_TIMEOUT', 600))
+# Seconds to wait for all nodes to pull a new image
+PREPULL_TIMEOUT = float(os.environ.get('K8S_PREPULL_TIMEOUT', 1800))
+PAUSE_IMAGE = os.environ.get('K8S_PAUSE_IMAGE', 'k8s.gcr.io/pause:3.1')
+# Number of concurrent API calls made by a batch launch
+LAUNCH_WORKERS = int(os.environ.get('K8S_LAUNCH_WORKERS', 16))
+LABELS = {'app': 'WholeTale'}
+
+IMAGE_INVENTORY = NodeImageInventory(list_kubernetes_node_images)
+_apis = None
+
+
+def _get_apis():
+    """
+    Returns the core, apps and extensions API clients, configured from the
+    worker's service account on first use.
+    """
+    global _apis
+    if _apis is None:
+        config.load_incluster_config()
+        _apis = (client.CoreV1Api(), client.AppsV1Api(), client.ExtensionsV1beta1Api())
+    return _apis
+
+
+def _ignore_missing(func, *args, **kwargs):
+    """Calls a delete method of the API, ignoring objects that don't exist."""
+    try:
+        func(*args, **kwargs)
+    except ApiException as e:
+        if e.status != 404:
+            raise
+
+
+def _webdav_url(mountpoint, **kwargs):
+    webdav = WEBDAV_URL or get_girder_api_url().rsplit('/api/v1', 1)[0]
+    return WEBDAV_URL_TEMPLATES[mountpoint].format(webdav=webdav, **kwargs)
+
+
+def _volume_manifests(volume_name, mountpoint, url, instance_id):
+    """Returns the PersistentVolume and its claim for a mount point."""
+    name = '{}-{}'.format(volume_name, mountpoint)
+    labels = dict(LABELS, **{'wholetale.org/volume': volume_name,
+                             'wholetale.org/instance': instance_id})
+    volume = {
+        'apiVersion': 'v1',
+        'kind': 'PersistentVolume',
+        'metadata': {'name': name, 'labels': labels},
+        'spec': {
+            'capacity': {'storage': '1Gi'},
+            'accessModes': ['ReadWriteMany'],
+            'storageClassName': '',
+            'persistentVolumeReclaimPolicy': 'Retain',
+            'csi': {
+                'driver': CSI_DRIVER,
+                'volumeHandle': name,
+                'volumeAttributes': {'url': url},
+            },
+        },
+    }
+    claim = {
+        'apiVersion': 'v1',
+        'kind': 'PersistentVolumeClaim',
+        'metadata': {'name': name, 'labels': labels},
+        'spec': {
+            'accessModes': ['ReadWriteMany'],
+            'storageClassName': '',
+            'volumeName': name,
+            'resources': {'requests': {'storage': '1Mi'}},
+        },
+    }
+    return volume, claim
+
+
+def _instance_manifests(host, volume_name, container_config, rendered_command,
+                        instance_id):
+    """Returns the Deployment, Service and Ingress of an instance."""
+    labels = dict(LABELS, **{'wholetale.org/host': host,
+                             'wholetale.org/instance': instance_id})
+    selector = {'wholetale.org/host': host}
+    container = {
+        'name': 'tale',
+        'image': container_config.image,
+        'env': [dict(zip(('name', 'value'), var.split('=', 1)))
+                for var in container_config.environment],
+        'ports': [{'containerPort': container_config.container_port}],
+        'volumeMounts': [
+            {'name': mountpoint,
+             'mountPath': os.path.join(container_config.target_mount, mountpoint)}
+            for mountpoint in MOUNTPOINTS],
+        'resources': {'limits': {'memory': str(container_config.mem_limit)}},
+        # The instance only gets traffic once its server answers
+        'readinessProbe': {
+            'httpGet': {'path': '/', 'port': container_config.container_port},
+            'periodSeconds': 2,
+            'failureThreshold': 3,
+        },
+    }
+    if rendered_command:
+        container['command'] = shlex.split(rendered_command)
+    if container_config.cpu_shares:
+        # cpu shares are relative to 1024 per cpu
+        container['resources']['requests'] = {
+            'cpu': '{}m'.format(int(container_config.cpu_shares) * 1000 // 1024)}
+    if container_config.container_user:
+        # Only numeric users can be enforced by the pod's security context
+        try:
+            container['securityContext'] = {
+                'runAsUser': int(container_config.container_user)}
+        except ValueError:
+            pass
+    pod_spec = {
+        'containers': [container],
+        'volumes': [
+            {'name': mountpoint,
+             'persistentVolumeClaim': {'claimName': '{}-{}'.format(volume_name, mountpoint)}}
+            for mountpoint in MOUNTPOINTS],
+    }
+    if IMAGE_PULL_SECRET:
+        pod_spec['imagePullSecrets'] = [{'name': IMAGE_PULL_SECRET}]
+    affinity = _image_affinity(container_config.image)
+    if affinity:
+        pod_spec['affinity'] = affinity
+
+    deployment = {
+        'apiVersion': 'apps/v1',
+        'kind': 'Deployment',
+        'metadata': {'name': host, 'labels': labels},
+        'spec': {
+            'replicas': 1,
+            'selector': {'matchLabels': selector},
+            'template': {'metadata': {'labels': labels}, 'spec': pod_spec},
+        },
+    }
+    service = {
+        'apiVersion': 'v1',
+        'kind': 'Service',
+        'metadata': {'name': host, 'labels': labels},
+        'spec': {
+            'selector': selector,
+            'ports': [{'port': 80, 'targetPort': container_config.container_port}],
+        },
+    }
+    fqdn = '{}.{}'.format(host, DOMAIN)
+    ingress = {
+        'apiVersion': 'extensions/v1beta1',
+        'kind': 'Ingress',
+        'metadata': {'name': host, 'labels': labels, 'annotations': {}},
+        'spec': {
+            'rules': [{
+                'host': fqdn,
+                'http': {'paths': [{
+                    'path': '/',
+                    'backend': {'serviceName': host, 'servicePort': 80}}]},
+            }],
+        },
+    }
+    if INGRESS_CLASS:
+        ingress['metadata']['annotations']['kubernetes.io/ingress.class'] = INGRESS_CLASS
+    if INGRESS_TLS_SECRET:
+        ingress['spec']['tls'] = [{'hosts': [fqdn], 'secretName': INGRESS_TLS_SECRET}]
+    return deployment, service, ingress
+
+
+def _image_affinity(image):
+    """
+    Returns an affinity preferring the nodes which already hold the image, as
+    a multi-GB pull would dominate the launch. Other nodes remain eligible.
+    """
+    try:
+        nodes = IMAGE_INVENTORY.nodes_with_image(image)
+    except ApiException as e:
+        logging.warning('Failed to read the image inventory: {}'.format(e))
+        nodes = []
+    if not nodes:
+        return None
+    return {'nodeAffinity': {'preferredDuringSchedulingIgnoredDuringExecution': [{
+        'weight': 100,
+        'preference': {'matchExpressions': [{
+            'key': 'kubernetes.io/hostname', 'operator': 'In', 'values': nodes}]},
+    }]}}
+
+
+def _prepull_manifest(name, image):
+    """Returns a DaemonSet which pulls `image` on every node, then idles."""
+    labels = dict(LABELS, **{'wholetale.org/prepull': name})
+    pod_spec = {
+        'initContainers': [{'name': 'pull', 'image': image,
+                            'command': ['/bin/sh', '-c', 'exit 0']}],
+        'containers': [{'name': 'pause', 'image': PAUSE_IMAGE}],
+    }
+    if IMAGE_PULL_SECRET:
+        pod_spec['imagePullSecrets'] = [{'name': IMAGE_PULL_SECRET}]
+    return {
+        'apiVersion': 'apps/v1',
+        'kind': 'DaemonSet',
+        'metadata': {'name': name, 'labels': labels},
+        'spec': {
+            'selector': {'matchLabels': {'wholetale.org/prepull': name}},
+            'template': {'metadata': {'labels': labels}, 'spec': pod_spec},
+        },
+    }
+
+
+def _wait_for_deployment(name, namespace, timeout=LAUNCH_TIMEOUT):
+    """Waits until the single replica of a Deployment passes its readiness probe."""
+    apps = _get_apis()[1]
+    try:
+        poll_until(lambda: apps.read_namespaced_deployment_status(name, namespace).status,
+                   lambda status: status.ready_replicas, timeout, initial_delay=0.5,
+                   max_delay=5)
+    except TimeoutError:
+        raise RuntimeError('Instance {} was not ready after {}s'.format(name, timeout))
+
+
+def _wait_for_deployments(names, namespace, timeout=LAUNCH_TIMEOUT):
+    """
+    Waits until the Deployments are ready, listing all of them at once.
+
+    :return: The names of the Deployments that weren't ready in time
+    :rtype: set
+    """
+    apps = _get_apis()[1]
+    pending = set(names)
+
+    def poll():
+        deployments = apps.list_namespaced_deployment(
+            namespace, label_selector=','.join('{}={}'.format(*_) for _ in LABELS.items()))
+        for deployment in deployments.items:
+            if deployment.status.ready_replicas:
+                pending.discard(deployment.metadata.name)
+        return pending
+
+    try:
+        poll_until(poll, lambda pending: not pending, timeout, initial_delay=0.5,
+                   max_delay=5)
+    except TimeoutError:
+        pass
+    return pending
+
+
+def _create_instance(namespace, payload, container_config):
+    """
+    Creates the Deployment, Service and Ingress of an instance.
+
+    :return: The instance's host name and url
+    :rtype: tuple
+    """
+    rendered_command, rendered_url_path = _render_container_command(container_config)
+    logging.info('config = ' + str(container_config))
+    logging.info('command = ' + str(rendered_command))
+
+    core, apps, extensions = _get_apis()
+    host = 'tmp-{}'.format(new_user(12).lower())
+    deployment, service, ingress = _instance_manifests(
+        host, payload['volumeName'], container_config, rendered_command,
+        payload['instanceId'])
+    try:
+        apps.create_namespaced_deployment(namespace, deployment)
+        core.create_namespaced_service(namespace, service)
+        extensions.create_namespaced_ingress(namespace, ingress)
+    except Exception:
+        _rollback(_delete_instance, host, namespace)
+        raise
+
+    url = '{proto}://{host}.{domain}/{path}'.format(
+        proto='https' if INGRESS_TLS_SECRET else 'http', host=host,
+        domain=DOMAIN, path=rendered_url_path)
+    return host, url
+
+
+def _delete_instance(name, namespace):
+    """Removes the Ingress, Service and Deployment of an instance, if they exist."""
+    core, apps, extensions = _get_apis()
+    _ignore_missing(extensions.delete_namespaced_ingress, name, namespace)
+    _ignore_missing(core.delete_namespaced_service, name, namespace)
+    _ignore_missing(apps.delete_namespaced_deployment, name, namespace,
+                    body=client.V1DeleteOptions(propagation_policy='Foreground'))
+
+
+def _delete_volumes(volume_name, namespace):
+    """Removes the PersistentVolumes and claims of an instance, if they exist."""
+    core = _get_apis()[0]
+    for mountpoint in MOUNTPOINTS:
+        name = '{}-{}'.format(volume_name, mountpoint)
+        _ignore_missing(core.delete_namespaced_persistent_volume_claim, name, namespace)
+        _ignore_missing(core.delete_persistent_volume, name)
+
+
+def _rollback(func, *args):
+    """Calls a delete function, logging its failure to keep the original error."""
+    try:
+        func(*args)
+    except Exception:
+        logging.exception('Failed to clean up {}'.format(args[0]))
+
+
+def _capture(func, *args):
+    """Returns the result of `func`, or the exception it raised."""
+    try:
+        return func(*args)
+    except Exception as e:
+        return e
+
+
+class KubernetesTasks(TasksBase):
+
+    def create_volume(self, instanceId: str):
+        """Create the PersistentVolumes and claims of the instance's mount points."""
+        user, instance = _get_user_and_instance(self.girder_client, instanceId)
+        core = _get_apis()[0]
+        namespace = get_kubernetes_namespace()
+        volume_name = 'wt-{}-{}'.format(instanceId, new_user(6)).lower()
+
+        try:
+            for mountpoint in MOUNTPOINTS:
+                url = _webdav_url(mountpoint, login=user['login'], taleId=instance['taleId'],
+                                  instanceId=instanceId)
+                volume, claim = _volume_manifests(volume_name, mountpoint, url, instanceId)
+                core.create_persistent_volume(volume)
+                core.create_namespaced_persistent_volume_claim(namespace, claim)
+        except Exception:
+            # Nothing refers to the volumes yet, so nothing else would remove them
+            _rollback(_delete_volumes, volume_name, namespace)
+            raise
+
+        return dict(
+            nodeId=None,
+            mountPoint=None,
+            volumeName=volume_name,
+            instanceId=instanceId,
+        )
+
+    def launch_container(self, payload):
+        """Launch the instance's Deployment and route its host to it."""
+        instance = self.girder_client.get('/instance/' + payload['instanceId'])
+        tale = self.girder_client.get('/tale/' + instance['taleId'])
+        container_config = _get_container_config(self.girder_client, tale)
+        namespace = get_kubernetes_namespace()
+        host, url = _create_instance(namespace, payload, container_config)
+
+        try:
+            _wait_for_deployment(host, namespace)
+            # The pod is ready, but the ingress may not route to it yet
+            payload['timeToReady'] = wait_until_ready(url)
+        except Exception:
+            # The instance doesn't get the name, so shutdown_container can't remove it
+            _rollback(_delete_instance, host, namespace)
+            raise
+
+        payload['url'] = url
+        payload['name'] = host
+        return payload
+
+    def launch_containers(self, payloads):
+        """Launch many instances at once, e.g. at the start of a class.
+
+        Each distinct Tale and image is only fetched once, the API calls are
+        made by a pool of LAUNCH_WORKERS threads, and all the Deployments are
+        watched with a single listing. An instance that fails to launch doesn't
+        fail the others.
+
+        :param payloads: The results of create_volume for each instance
+        :type payloads: list
+        :return: The launched payload, or the error, of each instance
+        :rtype: dict
+        """
+        gc = self.girder_client
+        progress = JobProgress(self.job_manager, total=2 + len(payloads))
+        results = [{'instanceId': payload['instanceId'], 'payload': None, 'error': None}
+                   for payload in payloads]
+
+        def fail(result, error):
+            logging.warning('Failed to launch {}: {}'.format(result['instanceId'], error))
+            result['error'] = str(error)
+
+        namespace = get_kubernetes_namespace()
+        with ThreadPoolExecutor(max_workers=LAUNCH_WORKERS) as executor:
+            with progress.stage('configs', 'Resolving the configs of the Tales'):
+                instances = list(executor.map(
+                    lambda payload: _capture(gc.get, '/instance/' + payload['instanceId']),
+                    payloads))
+                taleIds = list({instance['taleId'] for instance in instances
+                                if not isinstance(instance, Exception)})
+                # Instances of the same Tale share its config
+                configs = dict(zip(taleIds, executor.map(
+                    lambda taleId: _capture(gc.get, '/tale/' + taleId), taleIds)))
+                fetched = [taleId for taleId in taleIds
+                           if not isinstance(configs[taleId], Exception)]
+                configs.update(zip(fetched, _get_container_configs(
+                    gc, [configs[taleId] for taleId in fetched])))
+
+            def create(result, payload, instance):
+                if isinstance(instance, Exception):
+                    fail(result, instance)
+                elif isinstance(configs[instance['taleId']], Exception):
+                    fail(result, configs[instance['taleId']])
+                else:
+                    launched = _capture(_create_instance, namespace, payload,
+                                        configs[instance['taleId']])
+                    if isinstance(launched, Exception):
+                        fail(result, launched)
+                    else:
+                        host, url = launched
+                        result['payload'] = dict(payload, name=host, url=url)
+                progress.update('Created {}'.format(result['instanceId']))
+
+            with progress.stage('create', 'Creating the instances', steps=True):
+                list(executor.map(create, results, payloads, instances))
+
+        launched = [result for result in results if result['payload'] is not None]
+        with progress.stage('ready', 'Waiting for the instances to be ready'):
+            start = time.monotonic()
+            not_ready = _wait_for_deployments(
+                [result['payload']['name'] for result in launched], namespace)
+            for result in launched:
+                if result['payload']['name'] in not_ready:
+                    _rollback(_delete_instance, result['payload']['name'], namespace)
+                    fail(result, 'Instance was not ready after {}s'.format(LAUNCH_TIMEOUT))
+            launched = [result for result in launched if result['error'] is None]
+            remaining = max(LAUNCH_TIMEOUT - (time.monotonic() - start), 1)
+            # The pods are ready, but the ingress may not route to them yet
+            times = wait_until_all_ready(
+                [result['payload']['url'] for result in launched], remaining)
+            for result, seconds in zip(launched, times):
+                if isinstance(seconds, Exception):
+                    _rollback(_delete_instance, result['payload']['name'], namespace)
+                    fail(result, seconds)
+                else:
+                    result['payload']['timeToReady'] = seconds
+
+        for result in results:
+            if result['error'] is not None:
+                result['payload'] = None
+        failed = sum(1 for result in results if result['error'] is not None)
+        progress.info.update({'launched': len(results) - failed, 'failed': failed})
+        return {'results': results, 'summary': progress.summary()}
+
+    def update_container(self, instanceId, digest=None, **kwargs):
+        """Roll the instance's Deployment onto a new build of its image."""
+        user, instance = _get_user_and_instance(self.girder_client, instanceId)
+        tale = self.girder_client.get('/tale/' + instance['taleId'])
+        container_config = _get_container_config(self.girder_client, tale)
+        image = container_config.image
+        if digest:
+            image = '{}@{}'.format(image, digest)
+        apps = _get_apis()[1]
+        namespace = get_kubernetes_namespace()
+        name = instance['containerInfo']['name']
+        apps.patch_namespaced_deployment(name, namespace, {
+            'spec': {'template': {'spec': {'containers': [
+                {'name': 'tale', 'image': image}]}}}})
+        _wait_for_deployment(name, namespace)
+        return {'image_digest': digest}
+
+    def shutdown_container(self, instanceId):
+        """Remove the instance's Ingress, Service and Deployment."""
+        user, instance = _get_user_and_instance(self.girder_client, instanceId)
+        _delete_instance(instance['containerInfo']['name'], get_kubernetes_namespace())
+
+    def remove_volume(self, instanceId):
+        """Remove the instance's PersistentVolumes and claims."""
+        user, instance = _get_user_and_instance(self.girder_client, instanceId)
+        _delete_volumes(instance['containerInfo']['volumeName'], get_kubernetes_namespace())
+
+    def prepull_image(image_id):
+        """Pull an image on all nodes with a short-lived DaemonSet."""
+        apps = _get_apis()[1]
+        namespace = get_kubernetes_namespace()
+        image = urlparse(DEPLOYMENT.registry_url).netloc + '/' + image_id
+        name = 'prepull-{}'.format(image_id).lower()
+        try:
+            apps.create_namespaced_daemon_set(namespace, _prepull_manifest(name, image))
+        except ApiException as e:
+            if e.status == 409:
+                # The task is broadcast, another worker is taking care of it
+                return
+            raise
+        try:
+            deadline = time.monotonic() + PREPULL_TIMEOUT
+            while time.monotonic() < deadline:
+                status = apps.read_namespaced_daemon_set_status(name, namespace).status
+                if status.desired_number_scheduled and \
+                        status.number_ready == status.desired_number_scheduled:
+                    IMAGE_INVENTORY.refresh()
+                    break
+                time.sleep(5)
+            else:
+                logging.warning('{} was not pulled on all nodes after {}s'.format(
+                    image, PREPULL_TIMEOUT))
+        finally:
+            _ignore_missing(apps.delete_namespaced_daemon_set, name, namespace)
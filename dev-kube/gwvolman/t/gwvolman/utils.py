@@ -9,17 +9,23 @@ import os
 import random
 import re
 import string
+import tempfile
 import uuid
 import logging
-import jwt
 import hashlib
+import json
+import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     from urlparse import urlparse
 except ImportError:
     from urllib.parse import urlparse
-import docker
 
+from .cache import PersistentCache, TTLCache, CACHE_DIR
+from .deployment import DEPLOYMENT
 from .constants import \
     DataONELocations, MOUNTPOINTS
 
@@ -30,12 +36,37 @@ DOMAIN = os.environ.get('DOMAIN', 'dev.wholetale.org')
 TRAEFIK_ENTRYPOINT = os.environ.get("TRAEFIK_ENTRYPOINT", "http")
 REGISTRY_USER = os.environ.get('REGISTRY_USER', 'fido')
 REGISTRY_PASS = os.environ.get('REGISTRY_PASS')
+# Number of local files uploaded to DataONE in parallel by a single publish
+UPLOAD_WORKERS = int(os.environ.get('PUBLISH_UPLOAD_WORKERS', 4))
+# Max number of objects created per second on a single member node (0: no limit)
+MN_RATE_LIMIT = float(os.environ.get('PUBLISH_MN_RATE_LIMIT', 0))
+# Number of concurrent Girder requests used to prefetch item metadata
+PREFETCH_WORKERS = int(os.environ.get('GIRDER_PREFETCH_WORKERS', 8))
+# Number of external files downloaded concurrently when hashing them
+EXTERNAL_FETCH_WORKERS = int(os.environ.get('EXTERNAL_FETCH_WORKERS', 8))
+# Connect/read timeout in seconds for each external file request
+EXTERNAL_FETCH_TIMEOUT = float(os.environ.get('EXTERNAL_FETCH_TIMEOUT', 60))
+# Number of keep-alive connections kept open to each DataONE member node
+DATAONE_POOL_SIZE = int(os.environ.get('DATAONE_POOL_SIZE', 10))
+# Number of member node clients (one per node and token) kept by a worker
+DATAONE_CLIENT_CACHE_SIZE = int(os.environ.get('DATAONE_CLIENT_CACHE_SIZE', 32))
+# Directory and max total size in bytes of the environment tarballs kept on a node
+TARBALL_CACHE_DIR = os.environ.get('TARBALL_CACHE_DIR', os.path.join(CACHE_DIR, 'tarballs'))
+TARBALL_CACHE_SIZE = int(os.environ.get('TARBALL_CACHE_SIZE', 10 * 1024 ** 3))
+# Reference identical LICENSE and environment objects already on the member node
+# instead of uploading new copies
+DEDUP_ARTIFACTS = os.environ.get('PUBLISH_DEDUP_ARTIFACTS', '').lower() in ('1', 'true', 'yes')
+# Seconds for which an image's Girder document is reused by launches
+IMAGE_CACHE_TTL = float(os.environ.get('IMAGE_CACHE_TTL', 60))
+# Number of images, and of resolved container configs, kept by a worker
+CONTAINER_CONFIG_CACHE_SIZE = int(os.environ.get('CONTAINER_CONFIG_CACHE_SIZE', 256))
 
 MOUNTS = {}
 RETRIES = 5
 container_name_pattern = re.compile('tmp\.([^.]+)\.(.+)\Z')
 
 PooledContainer = namedtuple('PooledContainer', ['id', 'path', 'host'])
+ItemMetadata = namedtuple('ItemMetadata', ['item', 'file', 'path'])
 ContainerConfig = namedtuple('ContainerConfig', [
     'image', 'command', 'mem_limit', 'cpu_shares',
     'container_port', 'container_user', 'target_mount',
@@ -61,59 +92,50 @@ def size_notation_to_bytes(size):
     raise ValueError
 
 
-class Deployment(object):
-    """Container for WT-specific docker stack deployment configuration.
+class RateLimiter(object):
+    """Spaces out calls so that at most `rate` of them start per second.
 
-    This class allows to read and store configuration of services in a WT
-    deployment. It's meant to be used as a singleton across gwvolman.
+    The limiter is shared by all threads of a worker process, so that parallel
+    uploads from concurrent publish jobs don't add up against a member node.
     """
 
-    _dashboard_url = None
-    _girder_url = None
-    _registry_url = None
-    _traefik_network = None
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
 
-    def __init__(self):
-        self.docker_client = docker.from_env(version='1.28')
+    def wait(self):
+        """Block until the caller is allowed to issue the next request."""
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
 
-    @property
-    def traefik_network(self):
-        """str: Name of the overlay network used by traefik for ingress."""
-        if self._traefik_network is None:
-            service = self.docker_client.services.get('wt_dashboard')
-            self._traefik_network = \
-                service.attrs['Spec']['Labels']['traefik.docker.network']
-        return self._traefik_network
 
-    @property
-    def dashboard_url(self):
-        """str: Dashboard's public url."""
-        if self._dashboard_url is None:
-            self._dashboard_url = self.get_host_from_traefik_rule('wt_dashboard')
-        return self._dashboard_url
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
 
-    @property
-    def girder_url(self):
-        """str: Girder's public url."""
-        if self._girder_url is None:
-            self._girder_url = self.get_host_from_traefik_rule('wt_girder')
-        return self._girder_url
 
-    @property
-    def registry_url(self):
-        """str: Docker Registry's public url."""
-        if self._registry_url is None:
-            self._registry_url = self.get_host_from_traefik_rule('wt_registry')
-        return self._registry_url
-
-    def get_host_from_traefik_rule(self, service_name):
-        """Infer service's hostname from traefik frontend rule label."""
-        service = self.docker_client.services.get(service_name)
-        rule = service.attrs['Spec']['Labels']['traefik.frontend.rule']
-        return 'https://' + rule.split(':')[-1].split(',')[0].strip()
-
-
-DEPLOYMENT = Deployment()
+def get_rate_limiter(node_url, rate=MN_RATE_LIMIT):
+    """
+    Returns the process-wide rate limiter for a DataONE member node.
+
+    :param node_url: The url of the member node endpoint
+    :param rate: Max number of requests per second; only used on first call
+    :type node_url: str
+    :type rate: float
+    :return: The limiter associated with the member node
+    :rtype: RateLimiter
+    """
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(node_url)
+        if limiter is None:
+            limiter = _rate_limiters[node_url] = RateLimiter(rate)
+        return limiter
 
 
 def sample_with_replacement(a, size):
@@ -148,6 +170,33 @@ def _get_api_key(gc):
     return api_key
 
 
+def poll_until(poll, done, timeout, initial_delay=1.0, max_delay=30.0):
+    """
+    Calls `poll` until `done` is true for its result, waiting twice as long
+    after each attempt (with some jitter) up to `max_delay`.
+
+    :param poll: Returns the current state
+    :param done: Tells whether the state is final
+    :param timeout: Max number of seconds to wait
+    :type poll: callable
+    :type done: callable
+    :type timeout: float
+    :return: The final state
+    :raises TimeoutError: If the state isn't final after `timeout` seconds
+    """
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+    while True:
+        state = poll()
+        if done(state):
+            return state
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError('Gave up waiting after {}s'.format(timeout))
+        time.sleep(min(remaining, delay / 2 + random.uniform(0, delay / 2)))
+        delay = min(delay * 2, max_delay)
+
+
 def _get_user_and_instance(girder_client, instanceId):
     user = girder_client.get('/user/me')
     if user is None:
@@ -165,51 +214,109 @@ def get_env_with_csp(config):
         * 'environment' in config, but no 'CSP_HOSTS=...' -> append
         * 'environment' in config and has 'CSP_HOSTS=...' -> replace
 
+    The config itself is left unchanged.
     '''
     csp = "CSP_HOSTS='self' {}".format(DEPLOYMENT.dashboard_url)
-    try:
-        env = config['environment']
-        original_csp = next((_ for _ in env if _.startswith('CSP_HOSTS')), None)
-        if original_csp:
-            env[env.index(original_csp)] = csp  # replace
-        else:
-            env.append(csp)
-    except KeyError:
-        env = [csp]
+    env = list(config.get('environment') or [])
+    original_csp = next((i for i, _ in enumerate(env) if _.startswith('CSP_HOSTS')), None)
+    if original_csp is None:
+        env.append(csp)
+    else:
+        env[original_csp] = csp  # replace
     return env
 
 
+# Girder documents of the images, by the token they were read with and id
+_images = TTLCache(CONTAINER_CONFIG_CACHE_SIZE, IMAGE_CACHE_TTL)
+# Resolved container configs, by image, image version, Tale config and deployment
+_container_configs = TTLCache(CONTAINER_CONFIG_CACHE_SIZE, float('inf'))
+
+
+def _get_image(gc, imageId):
+    # Images are only shared by the launches of the same user, so that Girder
+    # still checks each user's access to the image
+    return _images.get_or_set((gc.token, imageId),
+                              lambda: gc.get('/image/%s' % imageId))
+
+
+def _resolve_container_config(image, tale):
+    tale_config = dict(image['config'] or {})
+    if tale['config']:
+        tale_config.update(tale['config'])
+
+    try:
+        mem_limit = size_notation_to_bytes(tale_config.get('memLimit', '2g'))
+    except (ValueError, TypeError):
+        mem_limit = 2 * 1024 ** 3
+    return ContainerConfig(
+        command=tale_config.get('command'),
+        container_port=tale_config.get('port'),
+        container_user=tale_config.get('user'),
+        cpu_shares=tale_config.get('cpuShares'),
+        environment=tuple(get_env_with_csp(tale_config)),
+        image=urlparse(DEPLOYMENT.registry_url).netloc + '/' + tale['imageId'],
+        mem_limit=mem_limit,
+        target_mount=tale_config.get('targetMount'),
+        url_path=tale_config.get('urlPath')
+    )
+
+
 def _get_container_config(gc, tale):
+    """
+    Returns the config of a Tale's container: the config of its image, updated
+    with the Tale's own config. Configs are resolved once per version of the
+    image and Tale config, and shared by all launches, which must not modify
+    them.
+
+    :param gc: A Girder client
+    :param tale: The Tale, or None for the default config
+    :type gc: girder_client.GirderClient
+    :type tale: dict
+    :rtype: ContainerConfig
+    """
     if tale is None:
-        container_config = {}  # settings['container_config']
-    else:
-        image = gc.get('/image/%s' % tale['imageId'])
-        tale_config = image['config'] or {}
-        if tale['config']:
-            tale_config.update(tale['config'])
+        return {}  # settings['container_config']
+    image = _get_image(gc, tale['imageId'])
+    configs = json.dumps([image['config'], tale['config']], sort_keys=True)
+    key = (tale['imageId'], image.get('updated'),
+           hashlib.sha1(configs.encode('utf-8')).hexdigest(),
+           DEPLOYMENT.registry_url, DEPLOYMENT.dashboard_url)
+    return _container_configs.get_or_set(
+        key, lambda: _resolve_container_config(image, tale))
+
 
+def _get_container_configs(gc, tales):
+    """
+    Returns the container config of many Tales at once, e.g. for a class that
+    launches the same Tale. The configs are resolved concurrently, and each
+    distinct image is fetched from Girder once. A Tale whose config can't be
+    resolved gets the exception instead, so that it doesn't fail the others.
+
+    :param gc: A Girder client
+    :param tales: The Tales
+    :type gc: girder_client.GirderClient
+    :type tales: list
+    :return: The ContainerConfig, or the exception, of each Tale
+    :rtype: list
+    """
+    def resolve(tale):
         try:
-            mem_limit = size_notation_to_bytes(tale_config.get('memLimit', '2g'))
-        except (ValueError, TypeError):
-            mem_limit = 2 * 1024 ** 3
-        container_config = ContainerConfig(
-            command=tale_config.get('command'),
-            container_port=tale_config.get('port'),
-            container_user=tale_config.get('user'),
-            cpu_shares=tale_config.get('cpuShares'),
-            environment=get_env_with_csp(tale_config),
-            image=urlparse(DEPLOYMENT.registry_url).netloc + '/' + tale['imageId'],
-            mem_limit=mem_limit,
-            target_mount=tale_config.get('targetMount'),
-            url_path=tale_config.get('urlPath')
-        )
-    return container_config
+            return _get_container_config(gc, tale)
+        except Exception as e:
+            return e
 
+    with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as executor:
+        return list(executor.map(resolve, tales))
 
-def _launch_container(volumeName, nodeId, container_config):
 
+def _render_container_command(container_config):
+    """
+    Renders the command and url path of a container with a new token.
+
+    :return: The command (or None to use the image's default) and url path
+    :rtype: tuple
+    """
     token = uuid.uuid4().hex
-    # command
     if container_config.command:
         rendered_command = \
             container_config.command.format(
@@ -223,12 +330,88 @@ def _launch_container(volumeName, nodeId, container_config):
             container_config.url_path.format(token=token)
     else:
         rendered_url_path = ''
+    return rendered_command, rendered_url_path
+
+
+def _instance_url(host, rendered_url_path):
+    return '{proto}://{host}.{domain}/{path}'.format(
+        proto=TRAEFIK_ENTRYPOINT, host=host, domain=DOMAIN,
+        path=rendered_url_path)
+
+
+def _create_service(cli, host, container_config, rendered_command, mounts,
+                    constraints, labels=None):
+    """
+    Creates the swarm service of a Tale container, routed by traefik to
+    `host`.`DOMAIN`.
+
+    :param labels: Labels added to the service, besides traefik's
+    :type labels: dict
+    """
+    import docker
+    service_labels = {
+        'traefik.port': str(container_config.container_port),
+        'traefik.enable': 'true',
+        'traefik.frontend.rule': 'Host:{}.{}'.format(host, DOMAIN),
+        'traefik.docker.network': DEPLOYMENT.traefik_network,
+        'traefik.frontend.passHostHeader': 'true',
+        'traefik.frontend.entryPoints': TRAEFIK_ENTRYPOINT
+    }
+    service_labels.update(labels or {})
+
+    # https://github.com/containous/traefik/issues/2582#issuecomment-354107053
+    endpoint_spec = docker.types.EndpointSpec(mode="vip")
+
+    return cli.services.create(
+        container_config.image,
+        command=rendered_command,
+        labels=service_labels,
+        env=container_config.environment,
+        mode=docker.types.ServiceMode('replicated', replicas=1),
+        networks=[DEPLOYMENT.traefik_network],
+        name=host,
+        mounts=mounts,
+        endpoint_spec=endpoint_spec,
+        constraints=constraints,
+        resources=docker.types.Resources(mem_limit=container_config.mem_limit)
+    )
+
+
+def _launch_container(volumeName, nodeId, container_config):
+    from .pool import launch_from_pool, _release_slot
+    from .readiness import wait_until_ready
+
+    # Use a pre-started container of the node's warm pool if there's one
+    launched = launch_from_pool(volumeName, nodeId, container_config)
+    pooled = launched is not None
+    if not pooled:
+        launched = _start_container(volumeName, nodeId, container_config)
+    service, attrs = launched
+
+    # Only hand out the url once the server answers on it
+    try:
+        attrs['timeToReady'] = wait_until_ready(attrs['url'])
+    except Exception:
+        # The instance won't get the service, so nothing else would remove it
+        try:
+            service.remove()
+        except Exception:
+            logging.exception('Failed to remove service {}'.format(service.name))
+        if pooled:
+            _release_slot(service.name)
+        raise
+    return service, attrs
+
+
+def _start_container(volumeName, nodeId, container_config):
+
+    rendered_command, rendered_url_path = _render_container_command(container_config)
 
     logging.info('config = ' + str(container_config))
     logging.info('command = ' + str(rendered_command))
-    cli = docker.from_env(version='1.28')
-    cli.login(username=REGISTRY_USER, password=REGISTRY_PASS,
-              registry=DEPLOYMENT.registry_url)
+    import docker
+    from .docker_client import DOCKER_CLIENT
+    from .inventory import LOCAL_DOCKER_INVENTORY
     # Fails with: 'starting container failed: error setting
     #              label on mount source ...: read-only file system'
     # mounts = [
@@ -247,39 +430,17 @@ def _launch_container(volumeName, nodeId, container_config):
         )
     host = 'tmp-{}'.format(new_user(12).lower())
 
-    # https://github.com/containous/traefik/issues/2582#issuecomment-354107053
-    endpoint_spec = docker.types.EndpointSpec(mode="vip")
-
-    service = cli.services.create(
-        container_config.image,
-        command=rendered_command,
-        labels={
-            'traefik.port': str(container_config.container_port),
-            'traefik.enable': 'true',
-            'traefik.frontend.rule': 'Host:{}.{}'.format(host, DOMAIN),
-            'traefik.docker.network': DEPLOYMENT.traefik_network,
-            'traefik.frontend.passHostHeader': 'true',
-            'traefik.frontend.entryPoints': TRAEFIK_ENTRYPOINT
-        },
-        env=container_config.environment,
-        mode=docker.types.ServiceMode('replicated', replicas=1),
-        networks=[DEPLOYMENT.traefik_network],
-        name=host,
-        mounts=mounts,
-        endpoint_spec=endpoint_spec,
-        constraints=['node.id == {}'.format(nodeId)],
-        resources=docker.types.Resources(mem_limit=container_config.mem_limit)
-    )
-
-    # Wait for the server to launch within the container before adding it
-    # to the pool or serving it to a user.
-    # _wait_for_server(host_ip, host_port, path) # FIXME
-
-    url = '{proto}://{host}.{domain}/{path}'.format(
-        proto=TRAEFIK_ENTRYPOINT, host=host, domain=DOMAIN,
-        path=rendered_url_path)
+    # The registry is only needed if the node has to pull the image
+    try:
+        login = not LOCAL_DOCKER_INVENTORY.has_image(nodeId, container_config.image)
+    except Exception as e:
+        logging.warning('Failed to read the image inventory: {}'.format(e))
+        login = True
+    service = DOCKER_CLIENT.call(
+        _create_service, host, container_config, rendered_command, mounts,
+        ['node.id == {}'.format(nodeId)], login=login)
 
-    return service, {'url': url}
+    return service, {'url': _instance_url(host, rendered_url_path)}
 
 
 def get_file_item(item_id, gc):
@@ -299,6 +460,45 @@ def get_file_item(item_id, gc):
         return None
 
 
+def prefetch_item_metadata(item_ids, gc, max_workers=PREFETCH_WORKERS):
+    """
+    Resolves the Girder item, its first file and its path for each of the
+    item ids, so that later stages of a publish don't have to ask Girder again.
+
+    Girder has no bulk endpoint for items or files, so those are fetched
+    concurrently. Paths are derived from the path of each parent folder, which
+    is looked up once per folder rather than once per item.
+
+    :param item_ids: The ids of the items
+    :param gc: The girder client
+    :param max_workers: The maximum number of concurrent requests
+    :type item_ids: list
+    :type max_workers: int
+    :return: A dict mapping each item id to its ItemMetadata
+    :rtype: dict
+    """
+    item_ids = list(dict.fromkeys(item_ids))
+    if not item_ids:
+        return dict()
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(item_ids)))) as executor:
+        # map() submits everything up front, so items and files are fetched together
+        files = executor.map(lambda item_id: get_file_item(item_id, gc), item_ids)
+        items = list(executor.map(gc.getItem, item_ids))
+        folder_ids = list(dict.fromkeys(item['folderId'] for item in items))
+        folder_paths = executor.map(
+            lambda folder_id: gc.get('resource/{}/path'.format(folder_id),
+                                     parameters={'type': 'folder'}),
+            folder_ids)
+        folder_paths = dict(zip(folder_ids, folder_paths))
+        files = list(files)
+
+    return {item_id: ItemMetadata(item=item,
+                                  file=file,
+                                  path=folder_paths[item['folderId']] + '/' + item['name'])
+            for item_id, item, file in zip(item_ids, items, files)}
+
+
 def is_dataone_url(url):
     """
     Checks if a url has dataone in it
@@ -429,6 +629,7 @@ def extract_user_id(jwt_token):
     :return: The ORCID ID
     :rtype: str, None if failure
     """
+    import jwt
     jwt_token = jwt.decode(jwt_token, verify=False)
     user_id = jwt_token.get('userId', None)
     if user_id is not None:
@@ -536,7 +737,262 @@ def compute_md5(file):
     return md5
 
 
-def filter_items(item_ids, gc):
+# md5 digests of Girder files, so that republishing doesn't re-hash the same data
+file_checksums = PersistentCache('checksums')
+
+
+def _file_checksum_keys(file_object):
+    """
+    Returns the cache keys under which the md5 of a Girder file may be stored.
+    Files with a sha512 (set by Girder's hashsum plugin) are keyed by content, so
+    copies of the same data share an entry. Otherwise the key is the file id
+    together with its size and modification time, which change on every write.
+
+    :param file_object: The Girder file
+    :type file_object: girder.models.file
+    :return: The list of keys, most specific first
+    :rtype: list
+    """
+    keys = list()
+    if file_object.get('sha512'):
+        keys.append('sha512:{}'.format(file_object['sha512']))
+    keys.append('file:{}:{}:{}'.format(
+        file_object['_id'], file_object.get('size'),
+        file_object.get('updated', file_object.get('created'))))
+    return keys
+
+
+def lookup_file_md5(file_object):
+    """
+    Finds the md5 of a Girder file without downloading it. The file document
+    itself is checked first, then the checksum cache. Girder only records an
+    md5 on the file when a checksum plugin has computed it, so it's usually
+    missing.
+
+    :param file_object: The Girder file
+    :type file_object: girder.models.file
+    :return: The hex digest of the file, or None if it isn't known
+    :rtype: str
+    """
+    digest = file_object.get('md5')
+    if digest:
+        return digest
+    for key in _file_checksum_keys(file_object):
+        digest = file_checksums.get(key)
+        if digest is not None:
+            return digest
+    return None
+
+
+def store_file_md5(file_object, digest):
+    """
+    Records the md5 of a Girder file in the checksum cache.
+
+    :param file_object: The Girder file
+    :param digest: The hex digest of the file's contents
+    :type file_object: girder.models.file
+    :type digest: str
+    """
+    for key in _file_checksum_keys(file_object):
+        file_checksums.set(key, digest)
+
+
+# md5 digests of external files along with the validators they were served with
+remote_checksums = PersistentCache('remote_checksums')
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """
+    Returns the process-wide session used to download external files. The
+    session keeps a pool of keep-alive connections for each host, sized so
+    that every fetch worker can hold one.
+
+    :return: The shared session
+    :rtype: requests.Session
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=EXTERNAL_FETCH_WORKERS)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+        return _http_session
+
+
+def get_remote_md5(url, session=None, timeout=EXTERNAL_FETCH_TIMEOUT):
+    """
+    Computes the md5 of the object at an HTTP url while downloading it, without
+    storing its contents. The digest is cached along with the response's ETag
+    and Last-Modified headers; later calls send them back, and a 304 response
+    returns the cached digest without transferring the object again.
+
+    :param url: The url of the object
+    :param session: The session to use, defaults to get_http_session()
+    :param timeout: The connect and read timeout in seconds
+    :type url: str
+    :type session: requests.Session
+    :type timeout: float
+    :return: The hex digest of the object
+    :rtype: str
+    :raises requests.exceptions.RequestException: If the download fails
+    """
+    session = session or get_http_session()
+    cached = remote_checksums.get(url)
+    headers = dict()
+    if cached is not None:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as resp:
+        if resp.status_code == 304 and cached is not None:
+            logging.debug('{} not modified, using cached md5'.format(url))
+            return cached['md5']
+        resp.raise_for_status()
+        md5 = hashlib.md5()
+        for chunk in resp.iter_content(chunk_size=65536):
+            md5.update(chunk)
+        etag = resp.headers.get('ETag')
+        last_modified = resp.headers.get('Last-Modified')
+
+    digest = md5.hexdigest()
+    if etag or last_modified:
+        remote_checksums.set(url, {'etag': etag,
+                                   'last_modified': last_modified,
+                                   'md5': digest})
+    return digest
+
+
+# md5 and size of the tarballs in TARBALL_CACHE_DIR, keyed by download url
+tarball_checksums = PersistentCache('tarball_checksums')
+
+
+def get_environment_tarball(download_url, timeout=EXTERNAL_FETCH_TIMEOUT):
+    """
+    Returns a local copy of the environment tarball at `download_url`, which
+    points to a fixed commit of a recipe. Tarballs are kept on disk, so a
+    given commit is only downloaded once per worker node. On a miss the
+    tarball is hashed while it's being written.
+
+    :param download_url: The url of the tarball, including the commit id
+    :param timeout: The connect and read timeout in seconds
+    :type download_url: str
+    :type timeout: float
+    :return: The path to the tarball, its md5 hex digest and its size
+    :rtype: tuple
+    :raises requests.exceptions.RequestException: If the download fails
+    """
+    name = hashlib.sha1(download_url.encode('utf-8')).hexdigest() + '.tar.gz'
+    path = os.path.join(TARBALL_CACHE_DIR, name)
+    entry = tarball_checksums.get(download_url)
+    if entry is not None:
+        try:
+            if os.path.getsize(path) == entry['size']:
+                logging.debug('Using cached environment tarball {}'.format(path))
+                # Keep recently used tarballs from being pruned
+                os.utime(path)
+                return path, entry['md5'], entry['size']
+        except FileNotFoundError:
+            # Not cached, or pruned by another process
+            pass
+
+    os.makedirs(TARBALL_CACHE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=TARBALL_CACHE_DIR, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file, \
+                get_http_session().get(download_url, stream=True, timeout=timeout) as resp:
+            resp.raise_for_status()
+            md5, size = spool_and_hash(resp.iter_content(chunk_size=65536), temp_file)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    tarball_checksums.set(download_url, {'md5': md5.hexdigest(), 'size': size})
+    _prune_tarball_cache(keep=path)
+    return path, md5.hexdigest(), size
+
+
+def _prune_tarball_cache(keep, max_size=TARBALL_CACHE_SIZE):
+    """Removes the least recently used tarballs until the cache fits in max_size."""
+    tarballs = list()
+    for name in os.listdir(TARBALL_CACHE_DIR):
+        if name.endswith('.tar.gz'):
+            stat = os.stat(os.path.join(TARBALL_CACHE_DIR, name))
+            tarballs.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in tarballs)
+    for _, size, name in sorted(tarballs):
+        if total <= max_size:
+            break
+        path = os.path.join(TARBALL_CACHE_DIR, name)
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+class IteratorStream(object):
+    """
+    A read-only file-like wrapper around an iterable of byte chunks, such as
+    the one returned by gc.downloadFileAsIterator. The length of the stream must
+    be known up front so that it can be used as a request body.
+    """
+
+    def __init__(self, chunks, size):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+        self._remaining = size
+
+    def __len__(self):
+        return self._remaining
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if size is None or size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._remaining = max(0, self._remaining - len(data))
+        return data
+
+
+def spool_and_hash(chunks, spool):
+    """
+    Writes an iterable of byte chunks to a file handle, computing the md5 of
+    the data while it's being written. Only one chunk is held in memory at a
+    time. The file handle is flushed and rewound so it can be read right away.
+
+    :param chunks: An iterable of bytes, e.g. from gc.downloadFileAsIterator
+    :param spool: An open, writable file handle
+    :return: The updated md5 object and the number of bytes written
+    :rtype: tuple
+    """
+    md5 = hashlib.md5()
+    size = 0
+    for chunk in chunks:
+        md5.update(chunk)
+        spool.write(chunk)
+        size += len(chunk)
+    spool.flush()
+    spool.seek(0)
+    return md5, size
+
+
+def filter_items(item_ids, gc, metadata=None):
     """
     Take a list of item ids and determine whether it:
        1. Exists on the local file system
@@ -544,7 +1000,9 @@ def filter_items(item_ids, gc):
        3. Is linked to a remote location other than DataONE
     :param item_ids: A list of items to be processed
     :param gc: The girder client
+    :param metadata: The prefetched item metadata, see prefetch_item_metadata
     :type item_ids: list
+    :type metadata: dict
     :return: A dictionary of lists for each file location
     For example,
      {'dataone': ['uuid:123456', 'doi.10x501'],
@@ -553,6 +1011,9 @@ def filter_items(item_ids, gc):
     :rtype: dict
     """
 
+    if metadata is None:
+        metadata = prefetch_item_metadata(item_ids, gc)
+
     # Holds item_ids for DataONE objects
     dataone_objects = list()
     # Holds item_ids for files not in DataONE
@@ -563,8 +1024,14 @@ def filter_items(item_ids, gc):
     local_items = list()
 
     for item_id in item_ids:
+        file = metadata[item_id].file
+        if file is None:
+            file_error = 'Failed to find the file with ID {}'.format(item_id)
+            logging.warning(file_error)
+            raise ValueError(file_error)
+
         # Check if it points do a dataone objbect
-        url = get_remote_url(item_id, gc)
+        url = file.get('linkUrl')
         if url is not None:
             if is_dataone_url(url):
                 dataone_objects.append(item_id)
@@ -581,7 +1048,7 @@ def filter_items(item_ids, gc):
         # If the file wasn't linked to a remote location, then it must exist locally. This
         # is a list of girder.models.File objects
         logging.debug('Adding local object')
-        local_objects.append(get_file_item(item_id, gc))
+        local_objects.append(file)
         local_items.append(item_id)
 
     return {'dataone': dataone_objects,